@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+from multiprocessing import Pool
+
+SCRIPTS = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for subdir in ('', 'znf-extraction', 'domain-clustering', 'krab-finder'):
+    sys.path.insert(0, os.path.join(SCRIPTS, subdir))
+
+import numpy as np
+import synthetic
+
+
+def _size(*filenames):
+    return sum(os.path.getsize(filename) for filename in filenames)
+
+
+def _fasta_records(filename):
+    with open(filename, 'rb') as infile:
+        return sum(line.startswith(b'>') for line in infile)
+
+
+# Each benchmark takes (datadir, species, params), does any untimed setup and
+# returns (function, args, items, bytes). Stages run in pipeline order and read
+# the files written by the stages before them.
+
+def bench_extract_longest_isoform(datadir, species, params):
+    from extract_longest_isoforms import extract_longest_isoform
+    jobs = [(f'{datadir}/seqs/{s}.aa.fa', f'{datadir}/gffs/{s}.gff',
+             f'{datadir}/seqs/{s}.longest_isoform.fa') for s in species]
+    items = sum(_fasta_records(seqfile) for seqfile, _, _ in jobs)
+    nbytes = sum(_size(seqfile, gfffile) for seqfile, gfffile, _ in jobs)
+    return lambda: [extract_longest_isoform(*job) for job in jobs], items, nbytes
+
+
+def bench_filter_znfs(datadir, species, params):
+    from parse_hmmer import filter_znfs
+    tables = [f'{datadir}/hmmer-out/{s}_znf.out' for s in species]
+    items = sum(sum(1 for line in open(table) if not line.startswith('#')) for table in tables)
+    return lambda: [filter_znfs(table) for table in tables], items, _size(*tables)
+
+
+def bench_write_znfs(datadir, species, params):
+    from parse_hmmer import write_znfs
+    jobs = [(f'{datadir}/hmmer-out/{s}_znf.out', f'{datadir}/seqs/{s}.longest_isoform.fa',
+             f'{datadir}/seqs/{s}_znfs.fa') for s in species]
+    items = sum(_fasta_records(seqfile) for _, seqfile, _ in jobs)
+    nbytes = sum(_size(hmmfile, seqfile) for hmmfile, seqfile, _ in jobs)
+    return lambda: [write_znfs(*job, cache=False) for job in jobs], items, nbytes
+
+
+def bench_load_znf_doms(datadir, species, params):
+    from extract_terminal_domains import load_znf_doms
+    tables = [f'{datadir}/hmmer-out/{s}_znf_domains.out' for s in species]
+    items = sum(sum(1 for line in open(table) if not line.startswith('#')) for table in tables)
+    return lambda: [load_znf_doms(s, datadir) for s in species], items, _size(*tables)
+
+
+def bench_extract_terminal_sequence(datadir, species, params):
+    from extract_terminal_domains import load_znf_doms, extract_terminal_sequence
+    doms = {s: load_znf_doms(s, datadir) for s in species}
+    seqfiles = [f'{datadir}/seqs/{s}_znfs.fa' for s in species]
+    items = sum(_fasta_records(seqfile) for seqfile in seqfiles)
+    return (lambda: [extract_terminal_sequence(s, doms[s], datadir) for s in species],
+            items, _size(*seqfiles))
+
+
+def _nterm_seqs(datadir, species, n):
+    from markov_cluster_nterm import load_seqs
+    seqs = []
+    for s in species:
+        seqs += load_seqs(f'{datadir}/seqs/{s}_znfs_nterm.fa')
+    return seqs[:n]
+
+
+def bench_calculate_distances(datadir, species, params):
+    from markov_cluster_nterm import calculate_distances
+    seqs = _nterm_seqs(datadir, species, params['nterm_seqs'])
+    nbytes = sum(len(record.seq) for record in seqs)
+    return (lambda: calculate_distances(seqs, f'{datadir}/edgelist.tsv'),
+            len(seqs)*(len(seqs) - 1)//2, nbytes)
+
+
+def bench_markov_clustering(datadir, species, params):
+    from markov_cluster_nterm import markov_clustering
+    edgefile = f'{datadir}/edgelist.tsv'
+    items = sum(1 for _ in open(edgefile))
+    return (lambda: markov_clustering(edgefile, f'{datadir}/clusters.tsv'),
+            items, _size(edgefile))
+
+
+def _hmm_observations(datadir, species, params):
+    from hmm2 import attribute_lookup
+    from train_hmm import random_hmm
+    # One symbol per residue, so data/amino_acid_attributes.txt is not needed
+    lookup, labels = attribute_lookup({aa: aa for aa in 'ACDEFGHIKLMNPQRSTVWY'}, unknown='A')
+    seqs = _nterm_seqs(datadir, species, params['hmm_seqs'])
+    observations = [lookup[np.frombuffer(record.seq.encode(), dtype=np.uint8)]
+                    for record in seqs if record.seq]
+    return random_hmm(params['hmm_states'], len(labels)), observations
+
+
+def bench_hmm_viterbi(datadir, species, params):
+    model, observations = _hmm_observations(datadir, species, params)
+    return (lambda: [model.viterbi(obs) for obs in observations],
+            len(observations), sum(len(obs) for obs in observations))
+
+
+def bench_hmm_forward(datadir, species, params):
+    model, observations = _hmm_observations(datadir, species, params)
+    return (lambda: [model.forward(obs) for obs in observations],
+            len(observations), sum(len(obs) for obs in observations))
+
+
+def bench_extract_kmers(datadir, species, params):
+    from kmer_analysis import extract_kmers, read_fasta
+    seqs = [seq for s in species for seq in read_fasta(f'{datadir}/seqs/{s}.aa.fa')]
+    return (lambda: [extract_kmers(seq, params['kmer_k']) for seq in seqs],
+            len(seqs), sum(len(seq) for seq in seqs))
+
+
+def bench_count_kmers(datadir, species, params):
+    from kmer_analysis import count_fasta
+    seqfiles = [f'{datadir}/seqs/{s}.aa.fa' for s in species]
+    return (lambda: [count_fasta(seqfile, params['kmer_k']) for seqfile in seqfiles],
+            sum(_fasta_records(seqfile) for seqfile in seqfiles), _size(*seqfiles))
+
+
+BENCHMARKS = {
+    'extract_longest_isoform': bench_extract_longest_isoform,
+    'filter_znfs': bench_filter_znfs,
+    'write_znfs': bench_write_znfs,
+    'load_znf_doms': bench_load_znf_doms,
+    'extract_terminal_sequence': bench_extract_terminal_sequence,
+    'calculate_distances': bench_calculate_distances,
+    'markov_clustering': bench_markov_clustering,
+    'HMM.viterbi': bench_hmm_viterbi,
+    'HMM.forward': bench_hmm_forward,
+    'extract_kmers': bench_extract_kmers,
+    'count_kmers': bench_count_kmers,
+}
+
+
+# The stage whose output files each stage reads, beyond the synthetic data
+REQUIRES = {
+    'write_znfs': 'extract_longest_isoform',
+    'extract_terminal_sequence': 'write_znfs',
+    'calculate_distances': 'extract_terminal_sequence',
+    'markov_clustering': 'calculate_distances',
+    'HMM.viterbi': 'extract_terminal_sequence',
+    'HMM.forward': 'extract_terminal_sequence',
+}
+
+
+def prerequisites(names):
+    """Returns the stages that must run before names, directly or indirectly."""
+    needed = set()
+    for name in names:
+        while name in REQUIRES:
+            name = REQUIRES[name]
+            needed.add(name)
+    return needed
+
+
+def _prepare(args):
+    name, datadir, species, params = args
+    function, _, _ = BENCHMARKS[name](datadir, species, params)
+    function()
+
+
+def _measure(args):
+    name, datadir, species, params = args
+    function, items, nbytes = BENCHMARKS[name](datadir, species, params)
+    setup_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+    start = time.perf_counter()
+    function()
+    elapsed = time.perf_counter() - start
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+    return {'seconds': elapsed, 'items': items, 'bytes': nbytes,
+            'items_per_sec': items/elapsed if elapsed else None,
+            'mb_per_sec': nbytes/2**20/elapsed if elapsed else None,
+            'peak_rss_mb': peak_rss, 'setup_rss_mb': setup_rss}
+
+
+def run(datadir, species, params, names=None, verbose=True):
+    """Runs the benchmarks in pipeline order, each in a fresh process.
+
+    Peak RSS is that of the benchmark's own process; setup_rss_mb is the
+    peak before the timed call, so peak - setup is the call's own growth.
+    When names selects a subset, skipped stages that write files a selected
+    stage reads are run first, untimed.
+    """
+    results = {}
+    setup = prerequisites(names) if names else set()
+    for name in BENCHMARKS:
+        if names and name not in names:
+            if name in setup:
+                if verbose:
+                    print(f'{name:<26} (untimed setup)', flush=True)
+                with Pool(1, maxtasksperchild=1) as pool:
+                    pool.map(_prepare, [(name, datadir, species, params)])
+            continue
+        with Pool(1, maxtasksperchild=1) as pool:
+            result = pool.map(_measure, [(name, datadir, species, params)])[0]
+        results[name] = result
+        if verbose:
+            print(f'{name:<26} {result["seconds"]:8.2f} s {result["items_per_sec"] or 0:12,.0f} items/s '
+                  f'{result["mb_per_sec"] or 0:8.1f} MB/s {result["peak_rss_mb"]:8.0f} MB peak', flush=True)
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=SCRIPTS,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baselinefile):
+    """Prints each benchmark's speed and peak memory relative to a previous run."""
+    with open(baselinefile) as infile:
+        baseline = json.load(infile)
+    print(f'\nRelative to {baseline.get("revision")} ({baselinefile}):')
+    for name, result in results.items():
+        old = baseline['results'].get(name)
+        if old is None:
+            continue
+        print(f'{name:<26} {old["seconds"]/result["seconds"]:6.2f}x faster '
+              f'{result["peak_rss_mb"]/old["peak_rss_mb"]:6.2f}x memory')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the pipeline hot paths on synthetic data.')
+    parser.add_argument('-o', '--out', default=None, help='JSON results file')
+    parser.add_argument('--datadir', default=None,
+                        help='where to write synthetic data (default: a temporary directory)')
+    parser.add_argument('--species', type=int, default=2)
+    parser.add_argument('--genes', type=int, default=5000, help='genes per species')
+    parser.add_argument('--isoforms', type=int, default=3)
+    parser.add_argument('--nterm-seqs', type=int, default=2000,
+                        help='N-terminal sequences for calculate_distances (quadratic)')
+    parser.add_argument('--hmm-seqs', type=int, default=1000)
+    parser.add_argument('--hmm-states', type=int, default=2)
+    parser.add_argument('--kmer-k', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS), default=None)
+    parser.add_argument('--compare', default=None, help='previous JSON results to compare with')
+    args = parser.parse_args()
+
+    params = {'species': args.species, 'genes': args.genes, 'isoforms': args.isoforms,
+              'nterm_seqs': args.nterm_seqs, 'hmm_seqs': args.hmm_seqs,
+              'hmm_states': args.hmm_states, 'kmer_k': args.kmer_k, 'seed': args.seed}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        datadir = os.path.abspath(args.datadir or tmpdir)
+        print(f'Generating {args.species} synthetic species in {datadir}', flush=True)
+        species = synthetic.generate(datadir, args.species, args.genes, args.isoforms,
+                                     seed=args.seed)
+        results = run(datadir, species, params, args.only)
+
+    report = {'revision': git_revision(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'python': platform.python_version(), 'numpy': np.__version__,
+              'machine': platform.machine(), 'cpus': os.cpu_count(),
+              'params': params, 'results': results}
+    if args.out:
+        with open(args.out, 'w') as outfile:
+            json.dump(report, outfile, indent=2)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+import os
+import argparse
+import numpy as np
+
+AMINO_ACIDS = np.frombuffer(b'ACDEFGHIKLMNPQRSTVWY', dtype=np.uint8)
+# C2H2 zinc finger (PF00096-like) with its TGEKP linker; x positions are randomized
+ZNF_MOTIF = b'YxCxxCGKxFxxxxxLxxHxxxHTGEKP'
+ZNF_LENGTH = 23  # Residues of the motif covered by a domain hit, excluding the linker
+
+
+def random_residues(rng, n):
+    return rng.choice(AMINO_ACIDS, n).tobytes()
+
+
+def mutate(rng, seq, rate):
+    """Substitutes a fraction rate of residues at random."""
+    seq = np.frombuffer(seq, dtype=np.uint8).copy()
+    sites = rng.random(len(seq)) < rate
+    seq[sites] = rng.choice(AMINO_ACIDS, sites.sum())
+    return seq.tobytes()
+
+
+def znf_array(rng, ndoms):
+    """Returns ndoms tandem zinc fingers and the 0-based start of each domain."""
+    motif = np.frombuffer(ZNF_MOTIF, dtype=np.uint8)
+    repeats = np.tile(motif, ndoms)
+    variable = repeats == ord('x')
+    repeats[variable] = rng.choice(AMINO_ACIDS, variable.sum())
+    return repeats.tobytes(), [i*len(motif) for i in range(ndoms)]
+
+
+def write_wrapped(outfile, header, seq, width=80):
+    outfile.write(f'>{header}\n')
+    for i in range(0, len(seq), width):
+        outfile.write(seq[i:i+width].decode() + '\n')
+
+
+def species_name(i):
+    return f'Synthetic_species{i}'
+
+
+def nterm_families(rng, nfamilies=50):
+    """Returns the N-terminal sequences that ZNF proteins are derived from."""
+    return [random_residues(rng, int(rng.integers(30, 300))) for _ in range(nfamilies)]
+
+
+def generate_species(datadir, species, ngenes=2000, isoforms=3, znf_fraction=0.3,
+                     families=None, seed=0):
+    """Writes a proteome, its GFF and HMMER tblout/domtblout tables for one species.
+
+    Files are named the way the znf-extraction scripts expect:
+    seqs/{species}.aa.fa, gffs/{species}.gff, hmmer-out/{species}_znf.out
+    (tblout over longest isoforms) and hmmer-out/{species}_znf_domains.out
+    (domtblout over the ZNF proteins). Isoform 1 of every gene is the
+    longest; the others drop zinc fingers or terminal residues. ZNF
+    N-termini are mutated copies of a shared set of families, so that
+    clustering finds structure.
+    """
+    rng = np.random.default_rng(seed)
+    if families is None:
+        families = nterm_families(np.random.default_rng(0))
+    for subdir in ('seqs', 'gffs', 'hmmer-out'):
+        os.makedirs(os.path.join(datadir, subdir), exist_ok=True)
+    tag = species.rsplit('species', 1)[-1]
+    with (open(f'{datadir}/seqs/{species}.aa.fa', 'w') as faa,
+          open(f'{datadir}/gffs/{species}.gff', 'w') as gff,
+          open(f'{datadir}/hmmer-out/{species}_znf.out', 'w') as tblout,
+          open(f'{datadir}/hmmer-out/{species}_znf_domains.out', 'w') as domtblout):
+        gff.write('##gff-version 3\n')
+        tblout.write('# target name  accession  query name  accession  ...\n')
+        domtblout.write('# target name  accession  tlen  query name  accession  qlen  ...\n')
+        position = 1
+        for g in range(ngenes):
+            gene = f'LOC{tag}_{g}'
+            is_znf = rng.random() < znf_fraction
+            if is_znf:
+                ndoms = int(rng.integers(2, 45))
+                nterm = mutate(rng, families[rng.integers(len(families))], 0.15)
+                znfs, starts = znf_array(rng, ndoms)
+                cterm = random_residues(rng, int(rng.integers(0, 100)))
+            else:
+                nterm = random_residues(rng, int(rng.integers(100, 800)))
+                znfs, starts, cterm = b'', [], b''
+            genelength = 3*(len(nterm) + len(znfs) + len(cterm))
+            gff.write(f'chr1\tRefSeq\tgene\t{position}\t{position + genelength}\t.\t+\t.\t'
+                      f'ID=gene-{gene};Name={gene};gbkey=Gene\n')
+            for i in range(int(rng.integers(1, isoforms + 1))):
+                protein, rna = f'XP_{tag}{g:07d}.{i + 1}', f'XM_{tag}{g:07d}.{i + 1}'
+                # Shorter isoforms lose zinc fingers (or N-terminal residues)
+                ndrop = min(i, len(starts) - 1) if starts else 0
+                trim = 0 if starts else i*10
+                seq = nterm[trim:] + znfs[:len(znfs) - ndrop*len(ZNF_MOTIF)] + cterm
+                doms = [len(nterm) + start for start in starts[:len(starts) - ndrop]]
+                write_wrapped(faa, f'{protein} zinc finger protein {g} isoform X{i + 1} [{species}]',
+                              seq)
+                gff.write(f'chr1\tRefSeq\tmRNA\t{position}\t{position + genelength}\t.\t+\t.\t'
+                          f'ID=rna-{rna};Parent=gene-{gene};gbkey=mRNA\n')
+                for exon in range(3):
+                    gff.write(f'chr1\tGnomon\tCDS\t{position + exon*100}\t{position + exon*100 + 99}'
+                              f'\t.\t+\t0\tID=cds-{protein};Parent=rna-{rna};gbkey=CDS\n')
+                if i == 0 and doms:
+                    ndoms = len(doms)
+                    tblout.write(f'{protein} - zf-C2H2 PF00096.29 1e-{ndoms*5} {ndoms*20.0:.1f} '
+                                 f'20.0 1e-5 20.0 0.1 {ndoms:.1f} {ndoms} 0 0 {ndoms} {ndoms} '
+                                 f'{ndoms} {ndoms} zinc finger protein {g}\n')
+                    if 5 <= ndoms <= 40:
+                        for d, start in enumerate(doms):
+                            domtblout.write(
+                                f'{protein} - {len(seq)} zf-C2H2 PF00096.29 23 1e-{ndoms*5} '
+                                f'{ndoms*20.0:.1f} 20.0 {d + 1} {ndoms} 1e-5 1e-3 20.0 0.1 1 23 '
+                                f'{start + 1} {start + ZNF_LENGTH} {start + 1} '
+                                f'{start + ZNF_LENGTH} 0.95 zinc finger protein {g}\n')
+            position += genelength + 1000
+
+
+def generate(datadir, nspecies=1, ngenes=2000, isoforms=3, znf_fraction=0.3, seed=0):
+    """Generates nspecies synthetic species and returns their names."""
+    names = [species_name(i) for i in range(nspecies)]
+    families = nterm_families(np.random.default_rng(seed))
+    for i, species in enumerate(names):
+        generate_species(datadir, species, ngenes, isoforms, znf_fraction, families, seed + i)
+    return names
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write synthetic ZNF proteomes, GFFs and HMMER tables.')
+    parser.add_argument('datadir')
+    parser.add_argument('--species', type=int, default=1)
+    parser.add_argument('--genes', type=int, default=2000, help='genes per species')
+    parser.add_argument('--isoforms', type=int, default=3, help='maximum isoforms per gene')
+    parser.add_argument('--znf-fraction', type=float, default=0.3)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    generate(args.datadir, args.species, args.genes, args.isoforms, args.znf_fraction, args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+import sys
+import time
+import resource
+import numpy as np
+from scipy import sparse
+from multiprocessing import Pool
+
+
+def edges_to_matrix(rows, cols, weights, nnodes):
+    """Builds the symmetric CSR adjacency matrix of an undirected edge list.
+
+    As in a networkx Graph, an edge listed more than once (in either
+    direction) keeps its last weight, and a self-loop is stored once.
+    """
+    rows, cols = np.minimum(rows, cols), np.maximum(rows, cols)
+    keys = rows.astype(np.int64)*nnodes + cols
+    _, last = np.unique(keys[::-1], return_index=True)
+    last = len(keys) - 1 - last
+    rows, cols, weights = rows[last], cols[last], np.asarray(weights)[last]
+    pairs = rows != cols
+    return sparse.coo_matrix((np.concatenate([weights, weights[pairs]]),
+                              (np.concatenate([rows, cols[pairs]]),
+                               np.concatenate([cols, rows[pairs]]))),
+                             shape=(nnodes, nnodes)).tocsr()
+
+
+def read_edgelist(filename, chunksize=1 << 24):
+    """Reads a tab-separated weighted edge list into a CSR matrix and label list.
+
+    Lines are read in chunks of about chunksize bytes and converted straight
+    to integer COO arrays. Node ids follow order of first appearance, as
+    networkx.read_weighted_edgelist does, so labels[i] is row i, and repeated
+    edges and self-loops are handled as in a networkx Graph.
+    """
+    node_ids = {}
+    rows, cols, weights = [], [], []
+    with open(filename) as infile:
+        while True:
+            lines = infile.readlines(chunksize)
+            if not lines:
+                break
+            fields = [line.split('\t') for line in lines]
+            if min(map(len, fields)) < 3 or '#' in ''.join(lines):
+                # Comments and blank lines are skipped, as networkx does
+                lines = [line.split('#', 1)[0].strip() for line in lines]
+                fields = [line.split('\t') for line in lines if line]
+                if not fields:
+                    continue
+            ids = [node_ids.setdefault(label, len(node_ids)) for f in fields for label in f[:2]]
+            ids = np.array(ids, dtype=np.int32)
+            rows.append(ids[0::2])
+            cols.append(ids[1::2])
+            weights.append(np.array([f[2] for f in fields], dtype=np.float64))
+    labels = list(node_ids)
+    if not labels:
+        return sparse.csr_matrix((0, 0)), labels
+    matrix = edges_to_matrix(np.concatenate(rows), np.concatenate(cols),
+                             np.concatenate(weights), len(labels))
+    return matrix, labels
+
+
+def pairs_to_matrix(seqlist, rows, cols, weights):
+    """Builds the adjacency matrix directly from scored pair arrays.
+
+    Sequences without edges are dropped, as they are from an edge list file.
+    """
+    nodes, inverse = np.unique(np.concatenate([rows, cols]), return_inverse=True)
+    inverse = inverse.ravel()
+    labels = [seqlist[i].id for i in nodes]
+    matrix = edges_to_matrix(inverse[:len(rows)], inverse[len(rows):], weights, len(nodes))
+    return matrix, labels
+
+
+def _load_networkx(filename):
+    import networkx as nx
+    graph = nx.read_weighted_edgelist(path=filename, delimiter='\t')
+    return nx.to_scipy_sparse_array(graph).nnz
+
+
+def _load_chunked(filename):
+    return read_edgelist(filename)[0].nnz
+
+
+def _measure(args):
+    loader, filename = args
+    start = time.perf_counter()
+    nnz = loader(filename)
+    elapsed = time.perf_counter() - start
+    return nnz, elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+
+
+def benchmark(filename):
+    """Reports load time and peak RSS of the networkx and chunked loaders.
+
+    Each loader runs in a fresh process so peak RSS is not shared.
+    """
+    for name, loader in (('networkx', _load_networkx), ('chunked', _load_chunked)):
+        with Pool(1, maxtasksperchild=1) as pool:
+            nnz, elapsed, rss = pool.map(_measure, [(loader, filename)])[0]
+        print(f'{name}: {elapsed:.1f} s, peak RSS {rss:,.0f} MB, {nnz} non-zeros')
+
+
+if __name__ == '__main__':
+    benchmark(sys.argv[1])
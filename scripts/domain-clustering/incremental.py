@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+
+import os
+import numpy as np
+import mcl
+import edgelist
+from kmer_index import KmerIndex
+from minhash_lsh import MinHashLSH, NUM_PERM
+
+
+def mcl_assignments(nnodes, rows, cols, weights, inflation=2.0, topk=None):
+    """Runs MCL on a weighted edge list and returns a cluster number per node.
+
+    Nodes without edges get -1, as they are absent from the clusters file
+    of a full run. Clusters are numbered in mcl.get_clusters order.
+    """
+    assignments = np.full(nnodes, -1, dtype=np.int64)
+    if not len(rows):
+        return assignments
+    nodes, inverse = np.unique(np.concatenate([rows, cols]), return_inverse=True)
+    inverse = inverse.ravel()
+    matrix = edgelist.edges_to_matrix(inverse[:len(rows)], inverse[len(rows):], weights,
+                                      len(nodes))
+    result = mcl.run_mcl(matrix, (inflation,), topk=topk, verbose=False)[inflation]
+    for number, cluster in enumerate(mcl.get_clusters(result)):
+        members = nodes[list(cluster)]
+        members = members[assignments[members] == -1]  # Overlaps keep their first cluster
+        assignments[members] = number
+    return assignments
+
+
+class ClusterState(object):
+    """K-mer index, MinHash sketches and cluster assignments kept between runs.
+
+    New sequences are sketched and scored only against the stored sketches
+    (plus each other) and attached to the clusters of their neighbours, so
+    adding a few species costs time in proportion to the new data. Once the
+    sequences added since the last full clustering exceed max_drift of that
+    clustering's size, everything is re-clustered from the stored index.
+    """
+
+    def __init__(self, ids, index, signatures, assignments, min_similarity=0.2,
+                 num_perm=NUM_PERM, seed=1, inflation=2.0, topk=None, base_size=None, added=0):
+        self.ids = list(ids)
+        self.index = index
+        self.assignments = np.asarray(assignments, dtype=np.int64)
+        self.min_similarity = min_similarity
+        self.num_perm = num_perm
+        self.seed = seed
+        self.inflation = inflation
+        self.topk = topk
+        self.lsh = MinHashLSH(index, min_similarity, num_perm, seed, signatures=signatures)
+        self.base_size = len(self.ids) if base_size is None else base_size
+        self.added = added
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def build(cls, ids, seqs, min_similarity=0.2, kmersize=5, num_perm=NUM_PERM, seed=1,
+              inflation=2.0, topk=None):
+        """Clusters seqs from scratch, exactly as the LSH mode of markov_cluster_nterm."""
+        index = KmerIndex(seqs, kmersize)
+        state = cls(ids, index, None, np.full(len(index), -1), min_similarity, num_perm,
+                    seed, inflation, topk)
+        state.recluster()
+        return state
+
+    def _similar(self, index, pairs):
+        similarity = index.jaccard_pairs(pairs[:, 0], pairs[:, 1])
+        keep = similarity >= self.min_similarity
+        return pairs[keep, 0], pairs[keep, 1], similarity[keep]
+
+    def recluster(self):
+        """Re-runs LSH scoring and MCL over every stored sequence."""
+        rows, cols, similarity = self._similar(self.index, self.lsh.candidate_pairs())
+        self.assignments = mcl_assignments(len(self), rows, cols, similarity,
+                                           self.inflation, self.topk)
+        self.base_size = len(self)
+        self.added = 0
+        return len(rows)
+
+    def drift(self, nnew=0):
+        return (self.added + nnew)/max(self.base_size, 1)
+
+    def add(self, ids, seqs, max_drift=0.2, verbose=True):
+        """Adds sequences, assigning them to clusters; returns a summary dict.
+
+        Sequences whose id is already stored are ignored.
+        """
+        known = set(self.ids)
+        new = [(name, seq) for name, seq in zip(ids, seqs) if name not in known]
+        summary = {'added': len(new), 'reclustered': False}
+        if not new:
+            if verbose:
+                print('no new sequences')
+            return summary
+        ids, seqs = zip(*new)
+        index = KmerIndex(seqs, self.index.kmersize)
+        lsh = MinHashLSH(index, self.min_similarity, self.num_perm, self.seed)
+
+        if self.drift(len(ids)) > max_drift:
+            self._append(ids, index, lsh.signatures, np.full(len(ids), -1))
+            summary['edges'] = self.recluster()
+            summary['reclustered'] = True
+            summary['clusters'] = int(self.assignments.max(initial=-1)) + 1
+            if verbose:
+                print(f'drift above {max_drift}: re-clustered {len(self)} sequences')
+            return summary
+
+        # Score new x stored (on a sub-index of the rows involved) and new x new
+        cross = self.lsh.query_pairs(lsh)
+        oldrows, inverse = np.unique(cross[:, 1], return_inverse=True)
+        pairindex = self.index.subset(oldrows)
+        pairindex.extend(index)
+        cross_new, cross_old, cross_sim = self._similar(
+            pairindex, np.stack([cross[:, 0] + len(oldrows), inverse.ravel()], axis=1))
+        cross_new -= len(oldrows)
+        cross_old = oldrows[cross_old]
+        new_i, new_j, new_sim = self._similar(index, lsh.candidate_pairs())
+
+        assignments = self._attach(len(ids), cross_new, cross_old, cross_sim,
+                                   new_i, new_j, new_sim)
+        attached = int((assignments >= 0).sum())
+
+        # Unattached new sequences, and stored singletons they link to, get new clusters
+        nold = len(self)
+        looseold = cross_old[(assignments[cross_new] == -1) &
+                             (self.assignments[cross_old] == -1)]
+        keep_new = (assignments[new_i] == -1) & (assignments[new_j] == -1)
+        keep_cross = (assignments[cross_new] == -1) & (self.assignments[cross_old] == -1)
+        rows = np.concatenate([nold + new_i[keep_new], nold + cross_new[keep_cross]])
+        cols = np.concatenate([nold + new_j[keep_new], cross_old[keep_cross]])
+        weights = np.concatenate([new_sim[keep_new], cross_sim[keep_cross]])
+        nodes = np.unique(np.concatenate([rows, cols]))
+        local = mcl_assignments(len(nodes), np.searchsorted(nodes, rows),
+                                np.searchsorted(nodes, cols), weights, self.inflation, self.topk)
+        first = int(self.assignments.max(initial=-1)) + 1
+        self._append(ids, index, lsh.signatures, assignments)
+        clustered = local >= 0
+        self.assignments[nodes[clustered]] = first + local[clustered]
+        self.added += len(ids)
+
+        summary.update(attached=attached, new_clusters=int(local.max(initial=-1)) + 1,
+                       unclustered=int((self.assignments[nold:] == -1).sum()),
+                       stored_singletons_joined=len(np.unique(looseold)),
+                       drift=round(self.drift(), 4))
+        if verbose:
+            print(f'{len(ids)} sequences added: {attached} attached to existing clusters, '
+                  f'{summary["new_clusters"]} new clusters, {summary["unclustered"]} unclustered '
+                  f'(drift {summary["drift"]:.3f})')
+        return summary
+
+    def _attach(self, nnew, cross_new, cross_old, cross_sim, new_i, new_j, new_sim):
+        """Assigns new sequences to the existing cluster they share most similarity with.
+
+        Attachment spreads through edges between new sequences, so a new
+        sequence whose only neighbours are other new sequences can follow
+        them into an existing cluster.
+        """
+        assignments = np.full(nnew, -1, dtype=np.int64)
+        clustered = self.assignments[cross_old] >= 0
+        sources = cross_new[clustered]
+        targets = self.assignments[cross_old[clustered]]
+        weights = cross_sim[clustered]
+        # Edges between new sequences, in both directions
+        links_i = np.concatenate([new_i, new_j])
+        links_j = np.concatenate([new_j, new_i])
+        link_sim = np.concatenate([new_sim, new_sim])
+        while len(sources):
+            # Sum similarity per (sequence, cluster) and keep each sequence's best cluster
+            pairs, inverse = np.unique(np.stack([sources, targets], axis=1), axis=0,
+                                       return_inverse=True)
+            totals = np.bincount(inverse.ravel(), weights=weights)
+            order = np.lexsort((-totals, pairs[:, 0]))
+            first = np.concatenate([[True], pairs[order[1:], 0] != pairs[order[:-1], 0]])
+            best = pairs[order[first]]
+            assignments[best[:, 0]] = best[:, 1]
+            newly = np.zeros(nnew, dtype=bool)
+            newly[best[:, 0]] = True
+            spread = newly[links_j] & (assignments[links_i] == -1)
+            sources = links_i[spread]
+            targets = assignments[links_j[spread]]
+            weights = link_sim[spread]
+        return assignments
+
+    def _append(self, ids, index, signatures, assignments):
+        self.ids += list(ids)
+        self.index.extend(index)
+        self.lsh = MinHashLSH(self.index, self.min_similarity, self.num_perm, self.seed,
+                              signatures=np.concatenate([self.lsh.signatures, signatures]))
+        self.assignments = np.concatenate([self.assignments, assignments])
+
+    def clusters(self):
+        """Returns lists of member ids, one per cluster number."""
+        clusters = [[] for _ in range(int(self.assignments.max(initial=-1)) + 1)]
+        for name, number in zip(self.ids, self.assignments.tolist()):
+            if number >= 0:
+                clusters[number].append(name)
+        return clusters
+
+    def write_clusters(self, outfilename):
+        """Writes id<TAB>cluster lines in the format of markov_cluster_nterm.write_clusters."""
+        with open(outfilename, 'w') as outfile:
+            for number, members in enumerate(self.clusters()):
+                for name in members:
+                    outfile.write(f'{name}\t{number}\n')
+
+    def save(self, filename):
+        with open(filename + '.tmp', 'wb') as outfile:
+            np.savez(outfile, ids=np.array(self.ids), sizes=self.index.sizes,
+                     codes=self.index.codes, kmersize=self.index.kmersize,
+                     signatures=self.lsh.signatures, assignments=self.assignments,
+                     min_similarity=self.min_similarity, num_perm=self.num_perm,
+                     seed=self.seed, inflation=self.inflation,
+                     topk=-1 if self.topk is None else self.topk,
+                     base_size=self.base_size, added=self.added)
+        os.replace(filename + '.tmp', filename)
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as npz:
+            index = KmerIndex.from_arrays(npz['sizes'], npz['codes'], int(npz['kmersize']))
+            topk = int(npz['topk'])
+            return cls(npz['ids'].tolist(), index, npz['signatures'], npz['assignments'],
+                       float(npz['min_similarity']), int(npz['num_perm']), int(npz['seed']),
+                       float(npz['inflation']), None if topk < 0 else topk,
+                       int(npz['base_size']), int(npz['added']))
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+
+import time
+import numpy as np
+from scipy import sparse
+
+
+def residue_lookup():
+    """Returns 5-bit residue codes for every byte; letters map to 0-25."""
+    lookup = np.full(256, 31, dtype=np.uint64)
+    for i in range(26):
+        lookup[ord('A') + i] = i
+        lookup[ord('a') + i] = i
+    lookup[ord('*')] = 26
+    return lookup
+
+
+RESIDUE_CODES = residue_lookup()
+
+
+def kmer_codes(seq, kmersize=5):
+    """Returns sorted unique k-mers of seq packed into uint64 (5 bits per residue)."""
+    residues = RESIDUE_CODES[np.frombuffer(seq.encode(), dtype=np.uint8)]
+    n = len(residues) - kmersize + 1
+    if n < 1:
+        return np.empty(0, dtype=np.uint64)
+    codes = np.zeros(n, dtype=np.uint64)
+    for i in range(kmersize):
+        codes = (codes << np.uint64(5)) | residues[i:i+n]
+    return np.unique(codes)
+
+
+def block_jaccard(matrix, sizes, rowstart, rowend, colstart, colend):
+    """Scores one block of a binary sequence x k-mer matrix against itself.
+
+    Only pairs with i > j and at least one shared k-mer are returned, sorted
+    by (i, j).
+    """
+    intersection = (matrix[rowstart:rowend] @ matrix[colstart:colend].T).tocoo()
+    i = intersection.row.astype(np.int64) + rowstart
+    j = intersection.col.astype(np.int64) + colstart
+    keep = i > j
+    i, j, shared = i[keep], j[keep], intersection.data[keep]
+    order = np.lexsort((j, i))
+    i, j, shared = i[order], j[order], shared[order]
+    return i, j, shared/(sizes[i] + sizes[j] - shared)
+
+
+class KmerIndex(object):
+    """Sorted k-mer codes of every sequence stored in a single CSR-style buffer.
+
+    Row i holds codes[indptr[i]:indptr[i+1]]. Sequences shorter than the
+    k-mer size have empty rows and never score against anything.
+    """
+
+    def __init__(self, seqs, kmersize=5):
+        self.kmersize = kmersize
+        self._set_rows([kmer_codes(seq, kmersize) for seq in seqs])
+
+    def _set_rows(self, rows):
+        self.sizes = np.array([len(row) for row in rows], dtype=np.int64)
+        self._set_codes(self.sizes, np.concatenate(rows) if rows else np.empty(0, dtype=np.uint64))
+
+    def _set_codes(self, sizes, codes):
+        self.sizes = sizes
+        self.indptr = np.zeros(len(sizes) + 1, dtype=np.int64)
+        np.cumsum(sizes, out=self.indptr[1:])
+        self.codes = codes
+        self._matrix = None
+
+    @classmethod
+    def from_arrays(cls, sizes, codes, kmersize=5):
+        """Rebuilds an index from its row sizes and concatenated codes, e.g. as saved."""
+        index = cls([], kmersize)
+        index._set_codes(np.asarray(sizes, dtype=np.int64), np.asarray(codes, dtype=np.uint64))
+        return index
+
+    def subset(self, rows):
+        """Returns a new index holding only the given rows, in that order."""
+        index = KmerIndex([], self.kmersize)
+        index._set_rows([self.row(i) for i in rows])
+        return index
+
+    def extend(self, other):
+        """Appends the rows of another index built with the same k-mer size."""
+        self._set_codes(np.concatenate([self.sizes, other.sizes]),
+                        np.concatenate([self.codes, other.codes]))
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def row(self, i):
+        return self.codes[self.indptr[i]:self.indptr[i+1]]
+
+    @property
+    def matrix(self):
+        """Binary sequence x k-mer CSR matrix over the k-mers present in the index."""
+        if self._matrix is None:
+            _, columns = np.unique(self.codes, return_inverse=True)
+            data = np.ones(len(self.codes), dtype=np.int32)
+            self._matrix = sparse.csr_matrix((data, columns.ravel(), self.indptr),
+                                             shape=(len(self), columns.max(initial=-1) + 1))
+        return self._matrix
+
+    def jaccard(self, i, j):
+        """Exact Jaccard index of two rows by merging their sorted codes."""
+        intersection = len(np.intersect1d(self.row(i), self.row(j), assume_unique=True))
+        union = self.sizes[i] + self.sizes[j] - intersection
+        return intersection/union if union else 0.0
+
+    def jaccard_pairs(self, rows, cols, batchsize=100000):
+        """Returns exact Jaccard indices for every (rows[n], cols[n]) pair."""
+        rows, cols = np.asarray(rows), np.asarray(cols)
+        similarity = np.zeros(len(rows))
+        for start in range(0, len(rows), batchsize):
+            r, c = rows[start:start+batchsize], cols[start:start+batchsize]
+            intersection = np.asarray(self.matrix[r].multiply(self.matrix[c]).sum(axis=1)).ravel()
+            union = self.sizes[r] + self.sizes[c] - intersection
+            np.divide(intersection, union, out=similarity[start:start+len(r)], where=union > 0)
+        return similarity
+
+    def block_pairs(self, rowstart, rowend, colstart, colend):
+        """Returns (i, j, jaccard) arrays for pairs in a block with i > j and shared k-mers."""
+        return block_jaccard(self.matrix, self.sizes, rowstart, rowend, colstart, colend)
+
+    def all_pairs(self, blocksize=2000):
+        """Yields (i, j, jaccard) blocks for every pair i > j with non-zero similarity.
+
+        Blocks are yielded in row order so concatenating them reproduces the
+        ordering of the nested loop in calculate_distances.
+        """
+        for start in range(0, len(self), blocksize):
+            end = min(start + blocksize, len(self))
+            yield self.block_pairs(start, end, 0, end)
+
+
+def benchmark(nseqs=2000, length=250, seed=0):
+    """Compares pairs/sec of the string jaccard loop against KmerIndex.all_pairs."""
+    from markov_cluster_nterm import jaccard
+    rng = np.random.default_rng(seed)
+    alphabet = np.frombuffer(b'ACDEFGHIKLMNPQRSTVWY', dtype=np.uint8)
+    seqs = [rng.choice(alphabet, length).tobytes().decode() for _ in range(nseqs)]
+    npairs = nseqs*(nseqs - 1)//2
+
+    sample = min(npairs, 50000)
+    start = time.perf_counter()
+    checked = 0
+    for i, seq1 in enumerate(seqs):
+        for seq2 in seqs[:i]:
+            jaccard(seq1, seq2)
+            checked += 1
+            if checked == sample:
+                break
+        if checked == sample:
+            break
+    loop_rate = sample/(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    index = KmerIndex(seqs)
+    for _ in index.all_pairs():
+        pass
+    index_rate = npairs/(time.perf_counter() - start)
+
+    print(f'jaccard loop: {loop_rate:,.0f} pairs/sec')
+    print(f'KmerIndex:    {index_rate:,.0f} pairs/sec ({index_rate/loop_rate:.0f}x)')
+
+
+if __name__ == '__main__':
+    benchmark()
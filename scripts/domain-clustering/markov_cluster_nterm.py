@@ -1,10 +1,19 @@
 #!/usr/bin/env python3
 
 from Bio import SeqIO
-import markov_clustering as mc
-import networkx as nx
 from collections import namedtuple
+import os
+import sys
 import random
+import argparse
+import mcl
+import minhash_lsh
+import parallel_distances
+import edgelist
+import incremental
+from kmer_index import KmerIndex
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import instrument
 
 def load_seqs(filename, samplesize=None):
     SimpleRecord = namedtuple('SimpleRecord', ['id', 'seq'])
@@ -21,43 +30,128 @@ def jaccard(seq1, seq2, kmersize=5):
     set2 = set(seq2[i:i+kmersize] for i in range(len(seq2) - kmersize + 1))
     return len(set1.intersection(set2))/len(set1.union(set2))
 
-def calculate_distances(seqlist, outfilename):
-    pairs = 1
+def calculate_distances(seqlist, outfilename, kmersize=5):
+    index = KmerIndex([record.seq for record in seqlist], kmersize)
     with open(outfilename, 'w') as outfile:
-        kmersize = 5
-        for i, seq1 in enumerate(seqlist):
-            for j, seq2 in enumerate(seqlist):
-                if j >= i:
-                    break
-                elif len(seq1.seq) < kmersize:
-                    continue
-                elif len(seq2.seq) < kmersize:
-                    continue
-                jaccard_dist = jaccard(seq1.seq, seq2.seq, kmersize)
-                if jaccard_dist:
-                    outfile.write(f'{seq1.id}\t{seq2.id}\t{jaccard_dist:.3f}\n')
-                if pairs % 1e5 == 0:
-                    print(f'{pairs} checked')
-                pairs += 1
-    print(pairs)
-
-def markov_clustering(weighted_edgelist, outfilename):
-    graph = nx.read_weighted_edgelist(path=weighted_edgelist, delimiter='\t')
-    matrix = nx.to_scipy_sparse_array(graph)
-    result = mc.run_mcl(matrix)           # run MCL with default parameters
-    clusters = mc.get_clusters(result)
-    nodelist = list(graph.nodes)
+        for rows, cols, similarity in index.all_pairs():
+            for i, j, jaccard_dist in zip(rows, cols, similarity):
+                outfile.write(f'{seqlist[i].id}\t{seqlist[j].id}\t{jaccard_dist:.3f}\n')
+            if len(rows):
+                print(f'{rows[-1] + 1} of {len(seqlist)} sequences checked')
+
+def calculate_distances_lsh(seqlist, outfilename, min_similarity=0.2, kmersize=5,
+                            num_perm=minhash_lsh.NUM_PERM):
+    """Writes the same edges as calculate_distances with jaccard >= min_similarity.
+
+    MinHash/LSH proposes candidate pairs so only those are scored exactly.
+    """
+    seqs = [record.seq for record in seqlist]
+    rows, cols, similarity = minhash_lsh.similar_pairs(seqs, min_similarity, kmersize, num_perm)
+    with open(outfilename, 'w') as outfile:
+        for i, j, jaccard_dist in zip(rows, cols, similarity):
+            outfile.write(f'{seqlist[i].id}\t{seqlist[j].id}\t{jaccard_dist:.3f}\n')
+    print(f'{len(rows)} edges written')
+    return rows, cols, similarity
+
+def write_clusters(clusters, labels, outfilename):
     with open(outfilename, 'w') as outfile:
         for i, cluster in enumerate(clusters):
             for node in cluster:
-                label = nodelist[node]
+                label = labels[node]
                 outfile.write(f'{label}\t{i}\n')
-        
+
+def cluster_matrix(matrix, labels, outfilename, inflations=(2.0,), topk=None):
+    """Writes one cluster file per inflation value.
+
+    With several inflations, files are named e.g. clusters_I2.0.txt next to
+    outfilename.
+    """
+    results = mcl.run_mcl(matrix, inflations, topk=topk)
+    for inflation, result in results.items():
+        if len(inflations) > 1:
+            stem, ext = os.path.splitext(outfilename)
+            filename = f'{stem}_I{inflation}{ext}'
+        else:
+            filename = outfilename
+        write_clusters(mcl.get_clusters(result), labels, filename)
+
+def markov_clustering(weighted_edgelist, outfilename, inflations=(2.0,), topk=None):
+    matrix, labels = edgelist.read_edgelist(weighted_edgelist)
+    cluster_matrix(matrix, labels, outfilename, inflations, topk)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Cluster N-terminal sequences by k-mer similarity.')
+    parser.add_argument('--exact', action='store_true',
+                        help='score all pairs instead of LSH candidates above --min-similarity')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='processes for exact all-pairs scoring (default: 1)')
+    parser.add_argument('--min-similarity', type=float, default=0.2)
+    parser.add_argument('--inflation', type=float, nargs='+', default=[2.0],
+                        help='one or more MCL inflation values, run in a single pass')
+    parser.add_argument('--topk', type=int, default=None,
+                        help='keep at most this many entries per MCL column')
+    parser.add_argument('--state', default=None,
+                        help='save the index, sketches and clusters here (LSH mode) so that '
+                        'sequences can later be added with --add')
+    parser.add_argument('--add', nargs='+', default=None, metavar='FASTA',
+                        help='assign the sequences in these files to the clusters in --state')
+    parser.add_argument('--max-drift', type=float, default=0.2,
+                        help='with --add, re-cluster everything once the sequences added since '
+                        'the last full clustering exceed this fraction of it')
+    args = parser.parse_args()
+    if args.add and not args.state:
+        parser.error('--add needs --state')
+    if args.state and args.exact:
+        parser.error('--state uses LSH scoring and cannot be combined with --exact')
+    return args
+
+def add_sequences(statefile, filenames, clusterfile, max_drift=0.2):
+    """Assigns the sequences in filenames to the clusters saved in statefile."""
+    state = incremental.ClusterState.load(statefile)
+    seqlist = [record for filename in filenames for record in load_seqs(filename)]
+    with instrument.stage('add_sequences', sequences=len(seqlist)) as stage:
+        summary = state.add([record.id for record in seqlist],
+                            [record.seq for record in seqlist], max_drift)
+        stage.records = summary['added']
+    state.save(statefile)
+    state.write_clusters(clusterfile)
+    instrument.emit('incremental', **summary)
+
 def main():
-    seqlist = load_seqs('../../data/seqs/unknown_nterm.fa', 30000)
-    calculate_distances(seqlist, '../../data/unknown_nterm_adjacency_list.txt')
-    markov_clustering('../../data/unknown_nterm_adjacency_list.txt',
-                      '../../data/unknown_nterm_clusters.txt')
+    args = parse_args()
+    clusterfile = '../../data/unknown_nterm_clusters.txt'
+    if args.add:
+        add_sequences(args.state, args.add, clusterfile, args.max_drift)
+        return
+    with instrument.stage('load_seqs') as stage:
+        seqlist = load_seqs('../../data/seqs/unknown_nterm.fa')
+        stage.records = len(seqlist)
+    edgefile = '../../data/unknown_nterm_adjacency_list.txt'
+    if args.state:
+        with instrument.stage('build_state') as stage:
+            state = incremental.ClusterState.build(
+                [record.id for record in seqlist], [record.seq for record in seqlist],
+                args.min_similarity, inflation=args.inflation[0], topk=args.topk)
+            state.save(args.state)
+            state.write_clusters(clusterfile)
+            stage.records = len(state)
+        return
+    with instrument.stage('calculate_distances', exact=args.exact, workers=args.workers) as stage:
+        if args.exact and args.workers > 1:
+            parallel_distances.calculate_distances_parallel(seqlist, edgefile, args.workers)
+        elif args.exact:
+            calculate_distances(seqlist, edgefile)
+        else:
+            pairs = calculate_distances_lsh(seqlist, edgefile, args.min_similarity)
+            stage.records = len(pairs[0])
+    with instrument.stage('markov_clustering') as stage:
+        if args.exact:
+            markov_clustering(edgefile, clusterfile, args.inflation, args.topk)
+        else:
+            # Cluster straight from the scored pairs rather than re-reading the edge list
+            matrix, labels = edgelist.pairs_to_matrix(seqlist, *pairs)
+            cluster_matrix(matrix, labels, clusterfile, args.inflation, args.topk)
+            stage.records = matrix.nnz
     
 if __name__ == "__main__":
     main()
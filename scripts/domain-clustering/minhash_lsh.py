@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+import numpy as np
+from kmer_index import KmerIndex
+
+HASH_PRIME = np.uint64(4294967291)  # Largest prime below 2**32
+MAX_HASH = np.uint64((1 << 32) - 1)
+# 256 permutations give 2 rows per band at the default 0.2 threshold; with 128
+# there is one, and any single shared min-hash makes a pair a candidate.
+NUM_PERM = 256
+MAX_BUCKET = 500  # Members a sequence is paired with per band in one bucket
+
+
+def choose_bands(num_perm, threshold, recall=0.99):
+    """Returns (bands, rows) giving at least `recall` for pairs at the threshold.
+
+    Larger rows per band produce fewer candidates, so the largest row count
+    that still meets the target recall is chosen.
+    """
+    best = (num_perm, 1)
+    for rows in range(1, num_perm + 1):
+        bands = num_perm // rows
+        if 1 - (1 - threshold**rows)**bands >= recall:
+            best = (bands, rows)
+    return best
+
+
+class PairKeys(object):
+    """Collects int64 pair keys, removing duplicates whenever the batch
+    added since the last pass outgrows the unique keys kept so far, so
+    memory stays within a small multiple of the number of unique pairs.
+    """
+
+    def __init__(self, minbatch=1 << 22):
+        self.minbatch = minbatch
+        self._unique = np.zeros(0, dtype=np.int64)
+        self._batch = []
+        self._batched = 0
+
+    def add(self, keys):
+        self._batch.append(keys)
+        self._batched += len(keys)
+        if self._batched >= max(self.minbatch, len(self._unique)):
+            self._dedupe()
+
+    def _dedupe(self):
+        if self._batch:
+            self._unique = np.unique(np.concatenate([self._unique] + self._batch))
+            self._batch, self._batched = [], 0
+
+    def pairs(self, n):
+        """Returns the unique keys, sorted, as (key // n, key % n) rows."""
+        self._dedupe()
+        return np.stack([self._unique // n, self._unique % n], axis=1)
+
+
+class MinHashLSH(object):
+    """MinHash sketches of a KmerIndex with LSH banding for candidate pairs.
+
+    Within a band, a sequence is paired with at most max_bucket other members
+    of its bucket. Members are shuffled per band, so sequences in oversized
+    buckets (typically low-complexity ones) meet different partners in each
+    band rather than being paired with all of them.
+    """
+
+    def __init__(self, index, threshold=0.2, num_perm=NUM_PERM, seed=1,
+                 blocksize=10000, signatures=None, max_bucket=MAX_BUCKET):
+        self.index = index
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.seed = seed
+        self.max_bucket = max_bucket
+        self.bands, self.rows = choose_bands(num_perm, threshold)
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, HASH_PRIME, num_perm, dtype=np.uint64)
+        self._b = rng.integers(0, HASH_PRIME, num_perm, dtype=np.uint64)
+        self._band_mix = rng.integers(1, 1 << 63, self.rows, dtype=np.uint64) | np.uint64(1)
+        # Signatures saved from an earlier run with the same seed can be reused
+        self.signatures = self.sketch(index, blocksize) if signatures is None else signatures
+
+    def sketch(self, index, blocksize=10000):
+        """Computes the (nseqs, num_perm) MinHash signature matrix of an index in blocks."""
+        signatures = np.full((len(index), self.num_perm), MAX_HASH, dtype=np.uint32)
+        for start in range(0, len(index), blocksize):
+            end = min(start + blocksize, len(index))
+            nonempty = np.flatnonzero(index.sizes[start:end])
+            if len(nonempty) == 0:
+                continue
+            # Folding codes below the prime keeps a*x + b inside uint64
+            codes = index.codes[index.indptr[start]:index.indptr[end]] % HASH_PRIME
+            offsets = index.indptr[start + nonempty] - index.indptr[start]
+            for p in range(self.num_perm):
+                hashed = (self._a[p] * codes + self._b[p]) % HASH_PRIME
+                signatures[start + nonempty, p] = np.minimum.reduceat(hashed, offsets)
+        return signatures
+
+    def _band_keys(self, band, signatures=None):
+        signatures = self.signatures if signatures is None else signatures
+        rows = signatures[:, band*self.rows:(band+1)*self.rows].astype(np.uint64)
+        return (rows * self._band_mix).sum(axis=1)
+
+    def _bucket_order(self, band, rows, keys):
+        """Returns rows sorted by band key, shuffled within buckets."""
+        rows = np.random.default_rng((self.seed, band)).permutation(rows)
+        return rows[np.argsort(keys[rows], kind='stable')]
+
+    def candidate_pairs(self):
+        """Returns unique (i, j) index pairs with i > j sharing at least one band."""
+        n = len(self.index)
+        valid = np.flatnonzero(self.index.sizes > 0)
+        pairkeys = PairKeys()
+        for band in range(self.bands):
+            keys = self._band_keys(band)
+            order = self._bucket_order(band, valid, keys)
+            sorted_keys = keys[order]
+            # Pair every member of a bucket with the next max_bucket members
+            # by comparing against neighbours at increasing offsets.
+            candidates = np.arange(len(order))
+            offset = 1
+            while len(candidates) and offset <= self.max_bucket:
+                candidates = candidates[candidates + offset < len(order)]
+                candidates = candidates[sorted_keys[candidates] == sorted_keys[candidates + offset]]
+                i, j = order[candidates], order[candidates + offset]
+                pairkeys.add(np.maximum(i, j).astype(np.int64) * n + np.minimum(i, j))
+                offset += 1
+        return pairkeys.pairs(n)
+
+    def query_pairs(self, other):
+        """Returns unique (i, j) pairs of a row i of other and a row j of self sharing a band.
+
+        other must use the same threshold, num_perm and seed, so that its
+        sketches are comparable. Only pairs across the two sets are formed,
+        so the cost grows with the size of other, not with pairs within self.
+        """
+        n = len(self.index)
+        mine = np.flatnonzero(self.index.sizes > 0)
+        theirs = np.flatnonzero(other.index.sizes > 0)
+        pairkeys = PairKeys()
+        for band in range(self.bands):
+            keys = self._band_keys(band)
+            order = self._bucket_order(band, mine, keys)
+            sorted_keys = keys[order]
+            query = self._band_keys(band, other.signatures)[theirs]
+            lo = np.searchsorted(sorted_keys, query, 'left')
+            counts = np.searchsorted(sorted_keys, query, 'right') - lo
+            counts = np.minimum(counts, self.max_bucket)
+            total = counts.sum()
+            if not total:
+                continue
+            # Expand each query's [lo, lo + count) bucket range into positions
+            starts = np.cumsum(counts) - counts
+            positions = np.arange(total) - np.repeat(starts - lo, counts)
+            i = np.repeat(theirs, counts).astype(np.int64)
+            pairkeys.add(i*n + order[positions])
+        return pairkeys.pairs(n)
+
+
+def similar_pairs(seqs, threshold=0.2, kmersize=5, num_perm=NUM_PERM):
+    """Returns (i, j, jaccard) arrays for pairs i > j whose exact Jaccard is >= threshold."""
+    index = KmerIndex(seqs, kmersize)
+    pairs = MinHashLSH(index, threshold, num_perm).candidate_pairs()
+    similarity = index.jaccard_pairs(pairs[:, 0], pairs[:, 1])
+    keep = similarity >= threshold
+    return pairs[keep, 0], pairs[keep, 1], similarity[keep]
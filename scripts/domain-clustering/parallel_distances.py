@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import shutil
+import hashlib
+import time
+import numpy as np
+from scipy import sparse
+from multiprocessing import Pool, shared_memory
+from kmer_index import KmerIndex, block_jaccard
+
+_matrix = None
+_sizes = None
+_shared = []
+
+
+def make_tiles(n, tilesize):
+    """Splits the lower-triangular pair space of n sequences into square tiles.
+
+    Off-diagonal tiles hold tilesize**2 pairs and diagonal tiles half that,
+    so tiles are of roughly equal cost.
+    """
+    tiles = []
+    for rowstart in range(0, n, tilesize):
+        rowend = min(rowstart + tilesize, n)
+        for colstart in range(0, rowend, tilesize):
+            tiles.append((rowstart, rowend, colstart, min(colstart + tilesize, rowend)))
+    return tiles
+
+
+def shard_path(sharddir, tile):
+    return os.path.join(sharddir, f'tile_{tile[0]}_{tile[2]}.npz')
+
+
+def _share(array):
+    """Copies array into a new shared memory block; returns (block, spec)."""
+    block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, array.dtype, buffer=block.buf)[:] = array
+    return block, (block.name, array.shape, array.dtype.str)
+
+
+def _attach(spec):
+    name, shape, dtype = spec
+    block = shared_memory.SharedMemory(name=name)
+    _shared.append(block)
+    return np.ndarray(shape, np.dtype(dtype), buffer=block.buf)
+
+
+def _init_worker(specs, shape):
+    global _matrix, _sizes
+    data, indices, indptr, sizes = [_attach(spec) for spec in specs]
+    _matrix = sparse.csr_matrix((data, indices, indptr), shape=shape, copy=False)
+    _sizes = sizes
+
+
+def _score_tile(args):
+    tile, sharddir = args
+    i, j, similarity = block_jaccard(_matrix, _sizes, *tile)
+    path = shard_path(sharddir, tile)
+    # Write then rename so a killed run never leaves a partial shard behind
+    with open(path + '.tmp', 'wb') as outfile:
+        np.savez(outfile, i=i.astype(np.int32), j=j.astype(np.int32), similarity=similarity)
+    os.replace(path + '.tmp', path)
+    return tile, (tile[1] - tile[0])*(tile[3] - tile[2])
+
+
+def _check_manifest(sharddir, manifest):
+    path = os.path.join(sharddir, 'manifest.json')
+    if os.path.exists(path):
+        with open(path) as infile:
+            if json.load(infile) != manifest:
+                raise ValueError(f'{sharddir} was written by a run with different sequences or '
+                                 'settings; remove it to start over')
+    else:
+        with open(path, 'w') as outfile:
+            json.dump(manifest, outfile)
+
+
+def score_tiles(index, sharddir, workers=4, tilesize=5000, checksum=None):
+    """Scores all tiles in a process pool, skipping tiles already in sharddir."""
+    os.makedirs(sharddir, exist_ok=True)
+    _check_manifest(sharddir, {'nseqs': len(index), 'tilesize': tilesize,
+                               'kmersize': index.kmersize, 'checksum': checksum})
+    tiles = make_tiles(len(index), tilesize)
+    todo = [tile for tile in tiles if not os.path.exists(shard_path(sharddir, tile))]
+    print(f'{len(tiles) - len(todo)} of {len(tiles)} tiles already complete')
+    if not todo:
+        return tiles
+
+    matrix = index.matrix
+    blocks, specs = zip(*[_share(array) for array in
+                          (matrix.data, matrix.indices, matrix.indptr, index.sizes)])
+    try:
+        start = time.perf_counter()
+        pairs = 0
+        with Pool(workers, initializer=_init_worker, initargs=(specs, matrix.shape)) as pool:
+            tasks = [(tile, sharddir) for tile in todo]
+            for done, (tile, npairs) in enumerate(pool.imap_unordered(_score_tile, tasks), 1):
+                pairs += npairs
+                elapsed = time.perf_counter() - start
+                remaining = elapsed/done*(len(todo) - done)
+                print(f'{done}/{len(todo)} tiles, {pairs/elapsed:,.0f} pairs/sec, '
+                      f'{remaining/60:.1f} min remaining', flush=True)
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+    return tiles
+
+
+def merge_shards(seqlist, tiles, sharddir, outfilename):
+    """Writes shards as the weighted edge list, in calculate_distances order."""
+    with open(outfilename, 'w') as outfile:
+        rowstarts = sorted(set(tile[0] for tile in tiles))
+        for rowstart in rowstarts:
+            shards = []
+            for tile in tiles:
+                if tile[0] == rowstart:
+                    with np.load(shard_path(sharddir, tile)) as shard:
+                        shards.append({key: shard[key] for key in ('i', 'j', 'similarity')})
+            i = np.concatenate([shard['i'] for shard in shards])
+            j = np.concatenate([shard['j'] for shard in shards])
+            similarity = np.concatenate([shard['similarity'] for shard in shards])
+            order = np.lexsort((j, i))
+            for a, b, jaccard_dist in zip(i[order], j[order], similarity[order]):
+                outfile.write(f'{seqlist[a].id}\t{seqlist[b].id}\t{jaccard_dist:.3f}\n')
+
+
+def calculate_distances_parallel(seqlist, outfilename, workers=4, tilesize=5000,
+                                 kmersize=5, sharddir=None):
+    """Parallel, resumable version of calculate_distances.
+
+    Tiles are written to sharddir (default: outfilename + '.shards') as they
+    finish, so rerunning after an interruption only scores missing tiles.
+    Shards are only reused for the same ids, sequences, k and tile size, and
+    sharddir is removed once the edge list is complete.
+    """
+    sharddir = sharddir or outfilename + '.shards'
+    checksum = hashlib.sha1()
+    for record in seqlist:
+        checksum.update(f'{record.id}\t{record.seq}\n'.encode())
+    index = KmerIndex([record.seq for record in seqlist], kmersize)
+    tiles = score_tiles(index, sharddir, workers, tilesize, checksum.hexdigest())
+    merge_shards(seqlist, tiles, sharddir, outfilename)
+    shutil.rmtree(sharddir)
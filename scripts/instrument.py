@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""Stage timing for the pipeline scripts, written as JSON lines.
+
+Instrumentation is off unless ZNF_METRICS is set, to a file to append to or
+to '-' for stderr. Each stage then writes one line with its wall time,
+records/sec, bytes read and written by the process while it ran (from
+/proc/self/io where available; process-wide, so stages running in
+parallel threads include each other's I/O), and current and peak RSS:
+
+    ZNF_METRICS=metrics.jsonl ./run_pipeline.py ...
+
+Scripts wrap each stage as
+
+    with instrument.stage('hmmsearch', species=species) as stage:
+        ...
+        stage.records += nhits
+
+and `./instrument.py metrics.jsonl` summarizes time by stage and species.
+
+Set ZNF_PROFILE to a comma-separated list of stage names (or 'all') to run
+those stages under cProfile. A .prof file is written per stage and species
+into ZNF_PROFILE_DIR (default '.'), for use with pstats or snakeviz.
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import cProfile
+import resource
+import threading
+from contextlib import contextmanager
+
+_lock = threading.Lock()
+
+
+def enabled():
+    return bool(os.environ.get('ZNF_METRICS'))
+
+
+def _profiled(name):
+    stages = os.environ.get('ZNF_PROFILE', '')
+    return stages == 'all' or name in stages.split(',')
+
+
+def io_counters():
+    """Returns (bytes read, bytes written) by this process so far, or (None, None)."""
+    try:
+        with open('/proc/self/io') as infile:
+            counters = dict(line.split(': ') for line in infile.read().splitlines())
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def rss_mb():
+    """Returns (current RSS, peak RSS) of this process in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak = peak/2**20 if sys.platform == 'darwin' else peak/1024
+    try:
+        with open('/proc/self/statm') as infile:
+            current = int(infile.read().split()[1])*os.sysconf('SC_PAGE_SIZE')/2**20
+    except OSError:
+        current = None
+    return current, peak
+
+
+def emit(event, **fields):
+    """Writes one JSON line, e.g. emit('skipped', species=species, reason='no data')."""
+    if not enabled():
+        return
+    record = {'event': event, 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'host': socket.gethostname(), 'pid': os.getpid(), **fields}
+    line = json.dumps(record, default=str) + '\n'
+    target = os.environ['ZNF_METRICS']
+    with _lock:
+        if target == '-':
+            sys.stderr.write(line)
+            sys.stderr.flush()
+        else:
+            with open(target, 'a') as outfile:
+                outfile.write(line)
+
+
+class Stage(object):
+    """Counters a stage can fill in while it runs."""
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+        self.records = 0
+        self.bytes_read = None  # Override the /proc/self/io figures when set
+        self.bytes_written = None
+
+
+@contextmanager
+def stage(name, **fields):
+    """Times the enclosed block and emits a 'stage' line for it.
+
+    fields (species, input file, ...) are added to the line. A stage that
+    raises is still recorded, with its error, and the exception propagates.
+    """
+    current = Stage(name, fields)
+    profiler = None
+    if _profiled(name):
+        profiler = cProfile.Profile()
+        profiler.enable()
+    read0, written0 = io_counters()
+    start = time.perf_counter()
+    error = None
+    try:
+        yield current
+    except BaseException as exception:
+        error = repr(exception)
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        if profiler is not None:
+            profiler.disable()
+            suffix = '.'.join(str(value) for value in fields.values())
+            profiledir = os.environ.get('ZNF_PROFILE_DIR', '.')
+            os.makedirs(profiledir, exist_ok=True)
+            profiler.dump_stats(os.path.join(profiledir, f'{name}.{suffix}.prof'
+                                             if suffix else f'{name}.prof'))
+        read1, written1 = io_counters()
+        if current.bytes_read is None and read0 is not None:
+            current.bytes_read = read1 - read0
+        if current.bytes_written is None and written0 is not None:
+            current.bytes_written = written1 - written0
+        rss, peak = rss_mb()
+        emit('stage', stage=name, **fields, seconds=round(elapsed, 6),
+             records=current.records,
+             records_per_sec=round(current.records/elapsed, 3) if elapsed else None,
+             bytes_read=current.bytes_read, bytes_written=current.bytes_written,
+             rss_mb=round(rss, 1) if rss is not None else None,
+             peak_rss_mb=round(peak, 1), error=error)
+
+
+def summarize(filename):
+    """Prints total and per-call time by stage, and the slowest species, from a metrics file."""
+    totals = {}
+    species = {}
+    with open(filename) as infile:
+        for line in infile:
+            record = json.loads(line)
+            if record.get('event') != 'stage':
+                continue
+            total = totals.setdefault(record['stage'], [0, 0.0, 0.0])
+            total[0] += 1
+            total[1] += record['seconds']
+            total[2] = max(total[2], record['peak_rss_mb'])
+            if 'species' in record:
+                species[record['species']] = species.get(record['species'], 0) + record['seconds']
+    print('stage\tcalls\tseconds\tmean_seconds\tpeak_rss_mb')
+    for name, (calls, seconds, peak) in sorted(totals.items(), key=lambda x: -x[1][1]):
+        print(f'{name}\t{calls}\t{seconds:.1f}\t{seconds/calls:.2f}\t{peak:.0f}')
+    if species:
+        print('\nspecies\tseconds')
+        for name, seconds in sorted(species.items(), key=lambda x: -x[1])[:20]:
+            print(f'{name}\t{seconds:.1f}')
+
+
+if __name__ == '__main__':
+    summarize(sys.argv[1])
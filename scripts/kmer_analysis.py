@@ -1,29 +1,353 @@
 #!/usr/bin/env python3
 
+import os
 import sys
-# from numpy import random
-import random
-from Bio import SeqIO
-from collections import Counter
+import argparse
+import instrument
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+AMINO_ACIDS = 'ACDEFGHIKLMNPQRSTVWY'
+INVALID = 255
+DENSE_LIMIT = 20**5  # Largest table counted in a flat array (25.6 MB of int64)
+MAX_K = 14  # Base-20 codes of longer k-mers overflow int64
+
+
+def residue_lookup():
+    """Returns a 256-entry table mapping residue bytes to 0-19, anything else to INVALID."""
+    lookup = np.full(256, INVALID, dtype=np.uint8)
+    for i, aa in enumerate(AMINO_ACIDS):
+        lookup[ord(aa)] = lookup[ord(aa.lower())] = i
+    return lookup
+
+RESIDUE_CODES = residue_lookup()
+
+
+def read_fasta(filename):
+    """Yields sequence bytes one record at a time."""
+    seq = None
+    with open(filename, 'rb') as infile:
+        for line in infile:
+            if line.startswith(b'>'):
+                if seq is not None:
+                    yield b''.join(seq)
+                seq = []
+            elif seq is not None:
+                seq.append(line.strip())
+    if seq is not None:
+        yield b''.join(seq)
+
+
+def rolling_codes(encoded, k):
+    """Returns base-20 codes of every k-mer in an encoded array, and a validity mask.
+
+    k-mers overlapping a residue outside the 20 standard amino acids are
+    marked invalid rather than counted.
+    """
+    if not 0 < k <= MAX_K:
+        raise ValueError(f'k must be between 1 and {MAX_K}')
+    n = len(encoded) - k + 1
+    if n <= 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=bool)
+    codes = np.zeros(n, dtype=np.int64)
+    for j in range(k):
+        codes *= 20
+        codes += encoded[j:j+n]
+    invalid = np.concatenate([[0], np.cumsum(encoded == INVALID)])
+    return codes, invalid[k:] == invalid[:n]
+
 
 def extract_kmers(seq, k=3, window=None):
-    if window == None:
-        seq = list(seq)
-    else:
-        seq = [c for c in seq[window[0]:window[-1]]]
-    seq_kmers = [''.join(seq[i:i+k]) for i in range(len(seq)-k)]
-    return seq_kmers
+    """Returns the integer codes of all k-mers in seq[window[0]:window[-1]].
+
+    Codes are base-20 over AMINO_ACIDS; use decode() to recover strings.
+    """
+    if isinstance(seq, str):
+        seq = seq.encode()
+    if window is not None:
+        seq = seq[window[0]:window[-1]]
+    codes, valid = rolling_codes(RESIDUE_CODES[np.frombuffer(seq, dtype=np.uint8)], k)
+    return codes[valid]
+
+
+def decode(codes, k):
+    """Converts k-mer codes back to strings."""
+    letters = np.array(list(AMINO_ACIDS))
+    digits = (np.asarray(codes)[:, None] // 20**np.arange(k - 1, -1, -1)) % 20
+    return [''.join(row) for row in letters[digits]]
+
+
+def merge_counts(codes, counts):
+    """Sums counts over repeated codes; returns (codes, counts) sorted by code."""
+    codes = np.concatenate(codes)
+    order = np.argsort(codes, kind='stable')
+    codes = codes[order]
+    counts = np.concatenate(counts)[order]
+    starts = np.flatnonzero(np.concatenate([[True], codes[1:] != codes[:-1]]))
+    if not len(codes):
+        return codes, counts
+    return codes[starts], np.add.reduceat(counts, starts)
+
+
+def merge_sorted(codes, counts, new_codes, new_counts):
+    """Adds sorted, unique new_codes into sorted, unique codes in linear time.
+
+    A stable sort of two concatenated sorted runs is a single timsort merge,
+    and each code then occurs at most twice, in adjacent positions.
+    """
+    merged = np.concatenate([codes, new_codes])
+    order = np.argsort(merged, kind='stable')
+    merged = merged[order]
+    counts = np.concatenate([counts, new_counts])[order]
+    repeats = np.flatnonzero(merged[1:] == merged[:-1])
+    counts[repeats] += counts[repeats + 1]
+    return np.delete(merged, repeats + 1), np.delete(counts, repeats + 1)
+
+
+class KmerTable(object):
+    """Sorted k-mer codes with their counts, mergeable and storable as .npz."""
+
+    def __init__(self, k, codes, counts, total=None):
+        self.k = k
+        self.codes = np.asarray(codes, dtype=np.int64)
+        self.counts = np.asarray(counts, dtype=np.int64)
+        self.total = int(self.counts.sum()) if total is None else total
+
+    def __len__(self):
+        return len(self.codes)
+
+    def save(self, filename):
+        with open(filename + '.tmp', 'wb') as outfile:
+            np.savez(outfile, k=self.k, codes=self.codes, counts=self.counts, total=self.total)
+        os.replace(filename + '.tmp', filename)
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as npz:
+            return cls(int(npz['k']), npz['codes'], npz['counts'], int(npz['total']))
+
+    @classmethod
+    def merge(cls, tables):
+        """Sums any number of tables with the same k."""
+        tables = list(tables)
+        if len({table.k for table in tables}) != 1:
+            raise ValueError('Can only merge tables with the same k')
+        codes, counts = merge_counts([table.codes for table in tables],
+                                     [table.counts for table in tables])
+        return cls(tables[0].k, codes, counts, sum(table.total for table in tables))
+
+    def lookup(self, codes):
+        """Returns counts for arbitrary codes, zero where unobserved."""
+        codes = np.asarray(codes, dtype=np.int64)
+        if not len(self.codes):
+            return np.zeros(len(codes), dtype=np.int64)
+        i = np.minimum(np.searchsorted(self.codes, codes), len(self.codes) - 1)
+        return np.where(self.codes[i] == codes, self.counts[i], 0)
+
+    def kmers(self):
+        return decode(self.codes, self.k)
+
+
+class KmerCounter(object):
+    """Accumulates k-mer counts over streamed sequences in bounded memory.
+
+    Sequences are buffered and joined with a separator so that each batch of
+    about buffersize residues is encoded and counted with a handful of NumPy
+    operations. Counts go into a flat 20^k array when that is small, and
+    otherwise into sorted (codes, counts) arrays that are merged batch by
+    batch, so memory tracks the number of distinct k-mers, not residues.
+    Since each merge copies the sorted arrays, batches grow with them to keep
+    the total cost linear.
+    """
+
+    def __init__(self, k=3, buffersize=1 << 22):
+        if not 0 < k <= MAX_K:
+            raise ValueError(f'k must be between 1 and {MAX_K}')
+        self.k = k
+        self.buffersize = buffersize
+        self.total = 0
+        self.dense = 20**k <= DENSE_LIMIT
+        if self.dense:
+            self._table = np.zeros(20**k, dtype=np.int64)
+        else:
+            self._codes = np.zeros(0, dtype=np.int64)
+            self._counts = np.zeros(0, dtype=np.int64)
+        self._buffer = []
+        self._buffered = 0
+
+    def update(self, seq, window=None):
+        """Adds the k-mers of one sequence (str or bytes)."""
+        if isinstance(seq, str):
+            seq = seq.encode()
+        if window is not None:
+            seq = seq[window[0]:window[-1]]
+        self._buffer.append(seq)
+        self._buffered += len(seq) + 1
+        if self._buffered >= self.buffersize and (self.dense or
+                                                  self._buffered >= len(self._codes)):
+            self.flush()
+
+    def add_fasta(self, filename, window=None):
+        for seq in read_fasta(filename):
+            self.update(seq, window)
+        self.flush()
+        return self
+
+    def flush(self):
+        if not self._buffer:
+            return
+        # '\n' encodes as INVALID, so no k-mer spans two sequences
+        joined = np.frombuffer(b'\n'.join(self._buffer), dtype=np.uint8)
+        self._buffer, self._buffered = [], 0
+        codes, valid = rolling_codes(RESIDUE_CODES[joined], self.k)
+        codes = codes[valid]
+        self.total += len(codes)
+        if self.dense:
+            self._table += np.bincount(codes, minlength=len(self._table))
+        else:
+            codes, counts = np.unique(codes, return_counts=True)
+            self._codes, self._counts = merge_sorted(self._codes, self._counts, codes, counts)
+
+    def table(self):
+        """Returns the counts so far as a KmerTable."""
+        self.flush()
+        if self.dense:
+            codes = np.flatnonzero(self._table)
+            return KmerTable(self.k, codes, self._table[codes], self.total)
+        return KmerTable(self.k, self._codes.copy(), self._counts.copy(), self.total)
+
+
+def count_fasta(filename, k=3, window=None):
+    return KmerCounter(k).add_fasta(filename, window).table()
+
+
+def table_path(filename, outdir, k, window=None):
+    """Returns {species}.k{k}.npz, or {species}.k{k}.w{start}-{end}.npz for a window."""
+    species = os.path.splitext(os.path.basename(filename))[0]
+    suffix = f'.w{window[0]}-{window[-1]}' if window is not None else ''
+    return os.path.join(outdir, f'{species}.k{k}{suffix}.npz')
+
+
+def _build_table(args):
+    filename, outfile, k, window = args
+    with instrument.stage('count_kmers', fasta=os.path.basename(filename), k=k) as stage:
+        table = count_fasta(filename, k, window)
+        table.save(outfile)
+        stage.records = table.total
+    return outfile
+
+
+def build_tables(filenames, outdir, k=3, window=None, workers=4):
+    """Counts each FASTA in a process pool and saves one table per file in outdir.
+
+    Tables newer than their FASTA are kept, so only new or changed files are
+    rescanned; k and the window are part of the table's name, so tables
+    counted with other settings are never reused. Returns the table paths in input order.
+    """
+    os.makedirs(outdir, exist_ok=True)
+    outfiles = [table_path(filename, outdir, k, window) for filename in filenames]
+    jobs = [(filename, outfile, k, window) for filename, outfile in zip(filenames, outfiles)
+            if not os.path.exists(outfile) or
+            os.path.getmtime(outfile) < os.path.getmtime(filename)]
+    with ProcessPoolExecutor(workers) as pool:
+        for outfile in pool.map(_build_table, jobs):
+            print(f'{outfile} written')
+    return outfiles
+
+
+def load_tables(filenames):
+    """Loads and merges the tables in filenames."""
+    return KmerTable.merge(KmerTable.load(filename) for filename in filenames)
+
+
+def enrichment(foreground, background, pseudocount=1.0):
+    """Compares k-mer frequencies of two tables.
+
+    Returns (codes, fg counts, bg counts, log2 ratio, z-score) over k-mers
+    seen in the foreground. The z-score is that of the foreground count under
+    a binomial with the (pseudocounted) background frequency.
+    """
+    codes, fg = foreground.codes, foreground.counts
+    bg = background.lookup(codes)
+    nkmers = 20**foreground.k
+    p_bg = (bg + pseudocount) / (background.total + pseudocount*nkmers)
+    p_fg = (fg + pseudocount) / (foreground.total + pseudocount*nkmers)
+    expected = foreground.total*p_bg
+    zscore = (fg - expected) / np.sqrt(expected*(1 - p_bg))
+    return codes, fg, bg, np.log2(p_fg/p_bg), zscore
+
+
+def print_counts(table):
+    order = np.argsort(table.counts, kind='stable')
+    for kmer, count in zip(decode(table.codes[order], table.k), table.counts[order]):
+        print(kmer, count)
+
+
+def print_enrichment(foreground, background, pseudocount=1.0):
+    codes, fg, bg, log2ratio, zscore = enrichment(foreground, background, pseudocount)
+    order = np.argsort(zscore, kind='stable')
+    print('kmer\tcount\tbackground\tlog2_ratio\tzscore')
+    for kmer, i in zip(decode(codes[order], foreground.k), order):
+        print(f'{kmer}\t{fg[i]}\t{bg[i]}\t{log2ratio[i]:.3f}\t{zscore[i]:.2f}')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Count and compare k-mers in FASTA files. '
+                                     'Without a command, "FASTA K" runs count.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    count = commands.add_parser('count', help='count one FASTA file')
+    count.add_argument('fasta')
+    count.add_argument('k', type=int)
+    count.add_argument('--window', type=int, nargs=2, metavar=('START', 'END'),
+                       help='only count residues START:END of each sequence')
+    count.add_argument('--background', help='FASTA to compute enrichment against')
+    count.add_argument('--pseudocount', type=float, default=1.0)
+
+    build = commands.add_parser('build', help='save a count table per FASTA file')
+    build.add_argument('fasta', nargs='+')
+    build.add_argument('-k', type=int, default=3)
+    build.add_argument('--outdir', default='../data/kmer-tables')
+    build.add_argument('--window', type=int, nargs=2, metavar=('START', 'END'))
+    build.add_argument('--workers', type=int, default=os.cpu_count())
+
+    merge = commands.add_parser('merge', help='merge saved tables into one')
+    merge.add_argument('tables', nargs='+')
+    merge.add_argument('-o', '--out', required=True)
+
+    compare = commands.add_parser('compare', help='k-mer enrichment between sets of tables')
+    compare.add_argument('--foreground', nargs='+', required=True)
+    compare.add_argument('--background', nargs='*', default=[],
+                         help='default: print foreground counts only')
+    compare.add_argument('--pseudocount', type=float, default=1.0)
+
+    argv = sys.argv[1:] if argv is None else list(argv)
+    if argv and argv[0] not in commands.choices and argv[0] not in ('-h', '--help'):
+        argv = ['count'] + argv  # The original `kmer_analysis.py FASTA K` form
+    return parser.parse_args(argv)
+
 
 def main():
-    seq_kmers = []
-    background_kmers = []
-    seqs = SeqIO.parse(sys.argv[1], 'fasta')
-    for seq in seqs:
-        skmer = extract_kmers(str(seq.seq), k=int(sys.argv[2]))
-        seq_kmers += skmer
-    seq_counter = Counter(seq_kmers)
-    for (k, v) in sorted(seq_counter.items(), key=lambda x: x[1]):
-        print(k, v)
+    args = parse_args()
+    if args.command == 'count':
+        with instrument.stage('count_kmers', fasta=os.path.basename(args.fasta), k=args.k) as stage:
+            table = count_fasta(args.fasta, args.k, args.window)
+            stage.records = table.total
+        if args.background is None:
+            print_counts(table)
+        else:
+            background = count_fasta(args.background, args.k, args.window)
+            print_enrichment(table, background, args.pseudocount)
+    elif args.command == 'build':
+        build_tables(args.fasta, args.outdir, args.k, args.window, args.workers)
+    elif args.command == 'merge':
+        load_tables(args.tables).save(args.out)
+    elif args.command == 'compare':
+        foreground = load_tables(args.foreground)
+        if args.background:
+            print_enrichment(foreground, load_tables(args.background), args.pseudocount)
+        else:
+            print_counts(foreground)
 
 if __name__ == "__main__":
     main()
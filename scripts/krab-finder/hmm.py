@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
 
+import os
+from functools import lru_cache
 import numpy as np
 from scipy.special import logsumexp
 
@@ -16,6 +18,27 @@ class MarkovChain():
         self._check_input()
         self.initial_probabilities = np.log(self.initial_probabilities)
         self.transition_probabilities = np.log(self.transition_probabilities)
+        self._build_lookup()
+
+    @classmethod
+    def from_log_probabilities(cls, states, log_initial, log_transition):
+        """Builds a chain from log probabilities without taking logs again."""
+        chain = cls.__new__(cls)
+        chain.state_labels = {label: state for (state, label) in enumerate(states)}
+        chain.states = np.arange(len(states))
+        chain.initial_probabilities = np.exp(np.asarray(log_initial, dtype='float32'))
+        chain.transition_probabilities = np.exp(np.asarray(log_transition, dtype='float32'))
+        chain._check_input()
+        chain.initial_probabilities = np.asarray(log_initial, dtype='float32')
+        chain.transition_probabilities = np.asarray(log_transition, dtype='float32')
+        chain._build_lookup()
+        return chain
+
+    def _build_lookup(self):
+        """Maps residue bytes to state indices; unknown residues map to -1."""
+        self._lookup = np.full(256, -1, dtype=np.int8)
+        for label, state in self.state_labels.items():
+            self._lookup[ord(label)] = state
 
     def _check_input(self, err=1e-2):
         """Checks transition_probabilities and emission probability matrix format."""
@@ -30,34 +53,89 @@ class MarkovChain():
                 print(sum(self.transition_probabilities[i]))
                 raise ValueError('transition_probabilities probs do not sum to 1')
     
+    def encode(self, sequence):
+        """Converts a sequence string to an int8 array of state indices."""
+        encoded = self._lookup[np.frombuffer(sequence.encode(), dtype=np.uint8)]
+        if (encoded < 0).any():
+            raise KeyError(f'unknown state in {sequence!r}')
+        return encoded
+
     def log_likelihood(self, sequence):
-        sequence = [self.state_labels[c] for c in sequence]
-        log_likelihood = self.initial_probabilities[sequence[0]]
-        for i in range(1, len(sequence)):
-            log_likelihood += self.transition_probabilities[sequence[i-1], sequence[i]]
-        return log_likelihood
+        sequence = self.encode(sequence)
+        return self.initial_probabilities[sequence[0]] + \
+               self.transition_probabilities[sequence[:-1], sequence[1:]].sum()
+
+    def log_likelihoods(self, sequences):
+        """Returns whole-sequence log-likelihoods of many sequences at once.
+
+        Sequences are concatenated and encoded once, every transition is
+        gathered in one fancy index and per-sequence sums are read off a
+        cumulative sum.
+        """
+        lengths = np.array([len(seq) for seq in sequences])
+        if (lengths == 0).any():
+            raise ValueError('empty sequence')
+        starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+        ends = starts + lengths
+        joined = self.encode(''.join(sequences))
+        steps = np.concatenate([[0], np.cumsum(
+            self.transition_probabilities[joined[:-1], joined[1:]], dtype=np.float64)])
+        # steps[end-1] - steps[start] leaves out the transition between sequences
+        return self.initial_probabilities[joined[starts]] + steps[ends - 1] - steps[starts]
+
+    def window_log_odds(self, sequence, background, window=20):
+        """Returns log-odds against a background chain for every window of the sequence.
+
+        Element i scores residues i to i+window-1 using their window-1
+        transitions; the profile has len(sequence)-window+1 entries, and
+        is empty for sequences shorter than the window.
+        """
+        if len(sequence) < window:
+            return np.empty(0)
+        encoded = self.encode(sequence)
+        background_states = background.encode(sequence)
+        odds = self.transition_probabilities[encoded[:-1], encoded[1:]] - \
+               background.transition_probabilities[background_states[:-1], background_states[1:]]
+        cumulative = np.concatenate([[0], np.cumsum(odds, dtype=np.float64)])
+        return cumulative[window-1:] - cumulative[:len(cumulative) - window + 1]
+
 
 
+@lru_cache(maxsize=None)
+def load_PAM30(filename='../../data/pam30.txt'):
+    """Returns amino acids and natural-log transition probabilities from PAM30.
 
-def load_PAM30():
-    with open('../../data/pam30.txt') as infile:
+    The parsed log matrix is cached next to the text file as .npz and reused
+    while it is newer than the text file.
+    """
+    cachefile = os.path.splitext(filename)[0] + '.npz'
+    if os.path.exists(cachefile) and os.path.getmtime(cachefile) >= os.path.getmtime(filename):
+        with np.load(cachefile) as cache:
+            return cache['amino_acids'].tolist(), cache['log_transition']
+    with open(filename) as infile:
         infile.readline()
         amino_acids = infile.readline().strip().split('\t')
         transition_probabilities = []
         for line in infile:
-            line = [2**(float(i)) for i in line.strip().split()]
+            # Entries are log2 scores, so 2**score becomes score*ln(2) in log space
+            line = [float(i)*np.log(2) for i in line.strip().split()]
             transition_probabilities.append(line)
-    return amino_acids, transition_probabilities
+    log_transition = np.array(transition_probabilities, dtype='float32')
+    # Written under a temporary name so other processes never see a partial cache
+    with open(cachefile + '.tmp', 'wb') as outfile:
+        np.savez(outfile, amino_acids=np.array(amino_acids), log_transition=log_transition)
+    os.replace(cachefile + '.tmp', cachefile)
+    return amino_acids, log_transition
     
 def main():
-    states, transition_probabilities = load_PAM30()
-    initial_probabilities = [1.0/len(states)]*len(states)
+    states, log_transition = load_PAM30()
+    log_initial = np.log([1.0/len(states)]*len(states))
     # initial_probabilities = [0.25, 0.25, 0.25, 0.25]
     # transition_probabilities = [[0.2, 0.1, 0.4, 0.3],
     #                             [0.1, 0.2, 0.4, 0.3],
     #                             [0.4, 0.1, 0.2, 0.3],
     #                             [0.3, 0.2, 0.3, 0.2]]
-    mc = MarkovChain(states, initial_probabilities, transition_probabilities)
+    mc = MarkovChain.from_log_probabilities(states, log_initial, log_transition)
 
     observed_sequence = 'MAFIKEESED'
     ll = mc.log_likelihood(observed_sequence)
@@ -1,6 +1,9 @@
 #!/usr/bin/env python3
 
+import os
+import time
 import numpy as np
+from multiprocessing import Pool
 from scipy.special import logsumexp
 import matplotlib.pyplot as plt
 
@@ -15,8 +18,14 @@ class HMM(object):
         self.emission = emission  # Emission probs given hidden states
         self.emission_states = np.array([i for i in range(emission.shape[1])])
         self._check_input()
+        self._cache_logs()
 
-
+    def _cache_logs(self):
+        """Stores log parameters used by the dynamic programming recurrences."""
+        with np.errstate(divide='ignore'):
+            self.log_initprobs = np.log(self.initprobs)
+            self.log_transition = np.log(self.transition)
+            self.log_emission = np.log(self.emission)
     
     def _check_input(self, err=1e-5):
         """Checks transition and emission probability matrix format."""
@@ -35,6 +44,16 @@ class HMM(object):
             if abs(1 - sum(self.emission[i])) > err:
                 raise ValueError('emission probs do not sum to 1')
 
+    def save(self, filename):
+        np.savez(filename, initprobs=self.initprobs, transition=self.transition,
+                 emission=self.emission)
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as params:
+            return cls(params['initprobs'].shape[0], params['initprobs'], params['transition'],
+                       params['emission'])
+
     def simulate(self, t):
         """Given t total states, simulate states and emitted data."""
         simhidden = [np.random.choice(self.states, p=self.initprobs)]
@@ -52,27 +71,17 @@ class HMM(object):
 
     def viterbi(self, observations):
         """Calculates the maximum likelihood state path given observed data."""
-        log_initprobs = np.log(self.initprobs)
-        log_transition = np.log(self.transition)
-        log_emission = np.log(self.emission)
-    
+        observations = np.asarray(observations)
+        emissions = self.log_emission[:, observations]
         tracemat = np.zeros((self.states.shape[0], len(observations)), int)
         scoremat = np.zeros((self.states.shape[0], len(observations)))
         
-        # Populate matrices
-        for i in self.states:
-            scoremat[i, 0] = log_initprobs[i] + \
-                             log_emission[i, observations[0]]
-        def prob(i, j, k, obs):
-            return scoremat[k, j-1] + \
-                   log_transition[k, i] + \
-                   log_emission[i, obs]
-        
-        for j, obs in enumerate(observations[1:], 1):
-            for i in self.states:
-                probs = np.array([prob(i, j, k, obs) for k in self.states])
-                scoremat[i, j] = probs.max()
-                tracemat[i, j] = np.argmax(probs)
+        # Populate matrices; probs[k, i] scores moving from state k to state i
+        scoremat[:, 0] = self.log_initprobs + emissions[:, 0]
+        for j in range(1, len(observations)):
+            probs = scoremat[:, j-1, np.newaxis] + self.log_transition
+            tracemat[:, j] = probs.argmax(axis=0)
+            scoremat[:, j] = probs[tracemat[:, j], self.states] + emissions[:, j]
          
         # Traceback 
         z = np.argmax(scoremat[:, -1])
@@ -88,50 +97,218 @@ class HMM(object):
         return preds[::-1], scores
 
     def forward(self, observations):
-        # TODO: Tricky bit here is dealing with logs of sums. This problem does
-        # not exist with Viterbi because we simply take the max prob at each
-        # step. For the forward algorithm, we can either take the computational
-        # hit or use log interpolation tables to approximate the correct answer.
-        
-        log_initprobs = np.log(self.initprobs)
-        log_transition = np.log(self.transition)
-        log_emission = np.log(self.emission)
-        
-        pathprob = []
-
-        startprob = []
-        for i in self.states:
-            x = log_emission[i, observations[0]] + log_initprobs[i]
-            startprob.append(x)
-        pathprob.append(logsumexp(startprob))
-
-        def prob(i, j, k, obs):
-            return pathprob[-1] + \
-                   log_transition[k, i] + \
-                   log_emission[i, obs]
-
-        for j, obs in enumerate(observations[1:], 1):
-            probs = []
-            for i in self.states:
-                for k in self.states:
-                    probs.append(prob(i, j, k, obs))
-            pathprob.append(logsumexp(probs))
-        
-        return np.exp(pathprob)
+        """Returns log forward probabilities, one row per state and column per position."""
+        observations = np.asarray(observations)
+        emissions = self.log_emission[:, observations]
+        logalpha = np.zeros((self.states.shape[0], len(observations)))
+        logalpha[:, 0] = self.log_initprobs + emissions[:, 0]
+        for j in range(1, len(observations)):
+            logalpha[:, j] = _log_dot(logalpha[:, j-1], self.transition) + emissions[:, j]
+        return logalpha
                 
     def backward(self, observations):
-        return self.forward(observations[::-1])[::-1]
+        """Returns log backward probabilities, one row per state and column per position."""
+        observations = np.asarray(observations)
+        emissions = self.log_emission[:, observations]
+        logbeta = np.zeros((self.states.shape[0], len(observations)))
+        for j in range(len(observations) - 2, -1, -1):
+            logbeta[:, j] = _log_dot(logbeta[:, j+1] + emissions[:, j+1], self.transition.T)
+        return logbeta
+
+    def log_likelihood(self, observations):
+        return logsumexp(self.forward(observations)[:, -1])
 
     def posterior_decoding(self, observations):
-        p = self.forward(observations)
-        q = self.backward(observations)
-        # pathp = np.log()
-        post = []
-        for i, val in enumerate(p):
-            post.append((val*q[i])/p[-1])
-        return post
+        """Returns posterior state probabilities, one row per state and column per position."""
+        logalpha = self.forward(observations)
+        logbeta = self.backward(observations)
+        return np.exp(logalpha + logbeta - logsumexp(logalpha[:, -1]))
+
+    def viterbi_batch(self, observations, lengths=None, offsets=None, batchsize=1024):
+        """Decodes many sequences at once; returns (paths, path log-probabilities).
+
+        observations is a list of sequences, a padded (nseqs, maxlen) array
+        with lengths, or a concatenated 1d array with nseqs+1 offsets.
+        """
+        padded, lengths = _pad(observations, lengths, offsets)
+        paths = [None]*len(lengths)
+        scores = np.zeros(len(lengths))
+        for batch in _length_batches(lengths, batchsize):
+            batch_paths, scores[batch] = self._viterbi_padded(padded[batch], lengths[batch])
+            for b, path in zip(batch, batch_paths):
+                paths[b] = path
+        return paths, scores
+
+    def _viterbi_padded(self, padded, lengths):
+        nseqs, maxlen = padded.shape[0], lengths.max()
+        tracemat = np.zeros((maxlen, nseqs, self.states.shape[0]), np.int16)
+        score = self.log_initprobs + self.log_emission[:, padded[:, 0]].T
+        for j in range(1, maxlen):
+            # probs[b, k, i] scores moving from state k to state i in sequence b
+            probs = score[:, :, np.newaxis] + self.log_transition
+            tracemat[j] = probs.argmax(axis=1)
+            best = np.take_along_axis(probs, tracemat[j][:, np.newaxis, :], axis=1)[:, 0, :]
+            active = (j < lengths)[:, np.newaxis]
+            score = np.where(active, best + self.log_emission[:, padded[:, j]].T, score)
+
+        # Traceback; sequences hold their final state until j reaches their end
+        state = score.argmax(axis=1)
+        paths = np.zeros((nseqs, maxlen), int)
+        for j in range(maxlen - 1, -1, -1):
+            active = j < lengths
+            paths[active, j] = state[active]
+            state = np.where(active, tracemat[j, np.arange(nseqs), state], state)
+        return [paths[b, :lengths[b]] for b in range(nseqs)], score.max(axis=1)
+
+    def forward_batch(self, observations, lengths=None, offsets=None, batchsize=1024):
+        """Returns log-likelihoods of many sequences; input as for viterbi_batch."""
+        padded, lengths = _pad(observations, lengths, offsets)
+        loglik = np.zeros(len(lengths))
+        for batch in _length_batches(lengths, batchsize):
+            seqs, seqlens = padded[batch], lengths[batch]
+            logalpha = self.log_initprobs + self.log_emission[:, seqs[:, 0]].T
+            for j in range(1, seqlens.max()):
+                m = logalpha.max(axis=1, keepdims=True)
+                m[m == -np.inf] = 0
+                with np.errstate(divide='ignore'):
+                    step = np.log(np.exp(logalpha - m) @ self.transition) + m
+                active = (j < seqlens)[:, np.newaxis]
+                logalpha = np.where(active, step + self.log_emission[:, seqs[:, j]].T, logalpha)
+            loglik[batch] = logsumexp(logalpha, axis=1)
+        return loglik
                 
 
+    def fit(self, sequences, max_iter=100, tol=1e-4, processes=1, chunksize=256,
+            checkpoint=None, verbose=True):
+        """Estimates parameters from unlabelled sequences with Baum-Welch.
+
+        Expected counts are accumulated over chunks of sequences in a pool of
+        worker processes and summed before each M-step. Training stops when
+        the total log-likelihood improves by less than tol. If checkpoint is
+        given, parameters are saved there after every iteration and training
+        resumes from it when it already exists. Returns the log-likelihood
+        of every completed iteration.
+        """
+        logliks = []
+        if checkpoint and os.path.exists(checkpoint):
+            with np.load(checkpoint) as params:
+                self.initprobs, self.transition, self.emission = \
+                    params['initprobs'], params['transition'], params['emission']
+                logliks = list(params['logliks'])
+            self._cache_logs()
+        sequences = sorted((np.asarray(seq) for seq in sequences), key=len)
+        nchunks = (len(sequences) + chunksize - 1)//chunksize
+        with Pool(processes, initializer=_init_estep, initargs=(sequences, chunksize)) as pool:
+            while len(logliks) < max_iter:
+                start = time.perf_counter()
+                params = (self.initprobs, self.transition, self.emission)
+                counts = pool.map(_expected_counts, [(params, i) for i in range(nchunks)])
+                init, trans, emit, loglik = [sum(c) for c in zip(*counts)]
+                self.initprobs = _normalize_rows(init, self.initprobs)
+                self.transition = _normalize_rows(trans, self.transition)
+                self.emission = _normalize_rows(emit, self.emission)
+                self._cache_logs()
+                logliks.append(loglik)
+                if checkpoint:
+                    # Saved through a handle, so no .npz is appended to the name, and
+                    # renamed into place, so a killed run never leaves a partial file
+                    with open(checkpoint + '.tmp', 'wb') as outfile:
+                        np.savez(outfile, initprobs=self.initprobs, transition=self.transition,
+                                 emission=self.emission, logliks=np.array(logliks))
+                    os.replace(checkpoint + '.tmp', checkpoint)
+                if verbose:
+                    print(f'iteration {len(logliks)}: log-likelihood {loglik:.2f}, '
+                          f'{time.perf_counter() - start:.1f} s', flush=True)
+                if len(logliks) > 1 and logliks[-1] - logliks[-2] < tol:
+                    break
+        return logliks
+
+
+_estep_sequences = None
+_estep_chunksize = None
+
+
+def _init_estep(sequences, chunksize):
+    global _estep_sequences, _estep_chunksize
+    _estep_sequences, _estep_chunksize = sequences, chunksize
+
+
+def _expected_counts(args):
+    """Scaled forward-backward over one chunk of sequences.
+
+    Returns expected initial-state, transition and emission counts and the
+    summed log-likelihood of the chunk. The whole chunk is processed as a
+    padded batch, one position at a time.
+    """
+    (initprobs, transition, emission), chunk = args
+    seqs = _estep_sequences[chunk*_estep_chunksize:(chunk + 1)*_estep_chunksize]
+    padded, lengths = _pad(seqs)
+    nseqs, maxlen = padded.shape
+    valid = np.arange(maxlen) < lengths[:, np.newaxis]
+    emitted = emission[:, padded].transpose(1, 2, 0)  # (nseqs, maxlen, nstates)
+
+    alpha = np.zeros(emitted.shape)
+    scale = np.ones((nseqs, maxlen))
+    a = initprobs*emitted[:, 0]
+    scale[:, 0] = a.sum(axis=1)
+    alpha[:, 0] = a/scale[:, 0, np.newaxis]
+    for t in range(1, maxlen):
+        a = (alpha[:, t-1] @ transition)*emitted[:, t]
+        scale[:, t] = np.where(valid[:, t], a.sum(axis=1), 1)
+        alpha[:, t] = a/scale[:, t, np.newaxis]
+
+    beta = np.ones(emitted.shape)
+    for t in range(maxlen - 2, -1, -1):
+        b = (emitted[:, t+1]*beta[:, t+1]/scale[:, t+1, np.newaxis]) @ transition.T
+        beta[:, t] = np.where(valid[:, t+1, np.newaxis], b, 1)
+
+    gamma = alpha*beta*valid[:, :, np.newaxis]
+    weighted = emitted[:, 1:]*beta[:, 1:]/scale[:, 1:, np.newaxis]*valid[:, 1:, np.newaxis]
+    trans = transition*np.einsum('bti,btj->ij', alpha[:, :-1], weighted)
+    emit = np.zeros(emission.shape)
+    for symbol in range(emission.shape[1]):
+        emit[:, symbol] = gamma[padded == symbol].sum(axis=0)
+    return gamma[:, 0].sum(axis=0), trans, emit, np.log(scale).sum()
+
+
+def _normalize_rows(counts, fallback):
+    """Normalizes counts to probabilities, keeping fallback rows that have no counts."""
+    totals = counts.sum(axis=-1, keepdims=True)
+    return np.where(totals > 0, counts/np.where(totals > 0, totals, 1), fallback)
+
+
+def _log_dot(logvec, matrix):
+    """Computes log(exp(logvec) @ matrix) without underflow."""
+    m = logvec.max()
+    if m == -np.inf:
+        return np.full(matrix.shape[1], -np.inf)
+    with np.errstate(divide='ignore'):
+        return np.log(np.exp(logvec - m) @ matrix) + m
+
+def _pad(observations, lengths=None, offsets=None):
+    """Returns observations as a zero-padded (nseqs, maxlen) array and lengths."""
+    if offsets is not None:
+        offsets = np.asarray(offsets)
+        lengths = np.diff(offsets)
+        padded = np.zeros((len(lengths), lengths.max(initial=1)), int)
+        padded[np.arange(padded.shape[1]) < lengths[:, np.newaxis]] = \
+            np.asarray(observations)[offsets[0]:offsets[-1]]
+        return padded, lengths
+    if lengths is not None:
+        return np.asarray(observations), np.asarray(lengths)
+    lengths = np.array([len(seq) for seq in observations])
+    padded = np.zeros((len(lengths), lengths.max(initial=1)), int)
+    for b, seq in enumerate(observations):
+        padded[b, :len(seq)] = seq
+    return padded, lengths
+
+
+def _length_batches(lengths, batchsize):
+    """Splits sequence indices into batches of similar length to limit padding."""
+    order = np.argsort(lengths, kind='stable')
+    return [order[i:i+batchsize] for i in range(0, len(order), batchsize)]
+
+
 def test_viterbi(n):
     state_code = ['G', 'I']
     obs_code = ['A', 'C', 'T', 'G']
@@ -170,9 +347,40 @@ def test_forward(n):
         so, sh = test.simulate(100)
         post = test.posterior_decoding(so)
         # print([f'{i:.2e}' for i in post ])
-        plt.plot(np.arange(len(post)), post)
+        plt.plot(np.arange(post.shape[1]), post[1])
         plt.show()
 
+def benchmark_batch(nseqs=1000, length=200):
+    """Times per-sequence viterbi/forward loops against the batch API."""
+    initprobs = np.array([0.99, 0.01], float)
+    transition = np.array([[0.99, 0.01],
+                           [0.05, 0.95]], float)
+    emission = np.array([[0.4, 0.1, 0.4, 0.1],
+                         [0.2, 0.3, 0.2, 0.3]], float)
+    test = HMM(2, initprobs, transition, emission)
+    seqs = [test.simulate(np.random.randint(length//2, length))[0] for _ in range(nseqs)]
+
+    start = time.perf_counter()
+    looped = [test.viterbi(seq)[0] for seq in seqs]
+    loop_viterbi = time.perf_counter() - start
+    start = time.perf_counter()
+    paths, _ = test.viterbi_batch(seqs)
+    batch_viterbi = time.perf_counter() - start
+    assert all(np.array_equal(a, b) for a, b in zip(looped, paths))
+
+    start = time.perf_counter()
+    looped = [test.log_likelihood(seq) for seq in seqs]
+    loop_forward = time.perf_counter() - start
+    start = time.perf_counter()
+    loglik = test.forward_batch(seqs)
+    batch_forward = time.perf_counter() - start
+    assert np.allclose(looped, loglik)
+
+    print(f'viterbi: loop {loop_viterbi:.2f} s, batch {batch_viterbi:.2f} s '
+          f'({loop_viterbi/batch_viterbi:.0f}x)')
+    print(f'forward: loop {loop_forward:.2f} s, batch {batch_forward:.2f} s '
+          f'({loop_forward/batch_forward:.0f}x)')
+
 def amino_acid_attributes():
     aadict = {}
     with open('../../data/amino_acid_attributes.txt') as infile:
@@ -182,6 +390,22 @@ def amino_acid_attributes():
             aadict[code] = attribute
     return aadict
 
+def attribute_lookup(aadict=None, unknown='X'):
+    """Returns (lookup, labels) mapping residue bytes to attribute indices.
+
+    lookup is a 256-entry array so whole sequences can be encoded with one
+    fancy index. Residues missing from aadict take the attribute of the
+    `unknown` residue when it is listed, otherwise index 0.
+    """
+    aadict = aadict or amino_acid_attributes()
+    labels = sorted(set(aadict.values()))
+    default = labels.index(aadict[unknown]) if unknown in aadict else 0
+    lookup = np.full(256, default, dtype=np.int8)
+    for code, attribute in aadict.items():
+        lookup[ord(code.upper())] = labels.index(attribute)
+        lookup[ord(code.lower())] = labels.index(attribute)
+    return lookup, labels
+
 def main():
     seq = """MKVIVIRHMHFDGDDDAGGADDDDDGDTDYDDDDDGYDDFDDDDEDNDTDTDDGVDIDDD\
 DTDDENGSSEGINQPLDAMNSDEHDEVIGDVHVCGNCRGEFVVFADFVKHKQNCIKKQVV\
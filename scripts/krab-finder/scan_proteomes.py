@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import glob
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from hmm2 import HMM, attribute_lookup
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import instrument
+
+_model = None
+_lookup = None
+
+
+def read_fasta(filename):
+    """Yields (id, sequence bytes) one record at a time."""
+    name, seq = None, []
+    with open(filename, 'rb') as infile:
+        for line in infile:
+            if line.startswith(b'>'):
+                if name is not None:
+                    yield name, b''.join(seq)
+                name, seq = line[1:].split(maxsplit=1)[0].decode(), []
+            else:
+                seq.append(line.strip())
+    if name is not None:
+        yield name, b''.join(seq)
+
+
+def chunked_records(filenames, chunksize):
+    """Yields (species, records) chunks of at most chunksize records.
+
+    Empty records are skipped, as they have no path to decode.
+    """
+    for filename in filenames:
+        species = os.path.basename(filename).removesuffix('_znfs.fa')
+        chunk = []
+        for record in read_fasta(filename):
+            if not record[1]:
+                continue
+            chunk.append(record)
+            if len(chunk) == chunksize:
+                yield species, chunk
+                chunk = []
+        if chunk:
+            yield species, chunk
+
+
+def segments(path):
+    """Returns (state, start, end) runs of a state path; end is exclusive."""
+    bounds = np.flatnonzero(np.diff(path)) + 1
+    starts = np.concatenate([[0], bounds])
+    ends = np.concatenate([bounds, [len(path)]])
+    return zip(path[starts], starts, ends)
+
+
+def _init_worker(modelfile):
+    global _model, _lookup
+    _model = HMM.load(modelfile)
+    _lookup, _ = attribute_lookup()
+
+
+def _scan_chunk(args):
+    species, records, background = args
+    observations = [_lookup[np.frombuffer(seq, dtype=np.uint8)] for _, seq in records]
+    paths, _ = _model.viterbi_batch(observations)
+    loglik = _model.forward_batch(observations)
+    rows = []
+    for (name, _), obs, path, ll in zip(records, observations, paths, loglik):
+        posterior = _model.posterior_decoding(obs)
+        for state, start, end in segments(path):
+            if state == background:
+                continue
+            rows.append(f'{species}\t{name}\t{len(obs)}\t{state}\t{start + 1}\t{end}\t'
+                        f'{posterior[state, start:end].mean():.3f}\t{ll:.2f}\n')
+    return rows
+
+
+def scan(filenames, modelfile, outfilename, workers=4, chunksize=500, background=0):
+    """Scans FASTA files with the HMM and writes one row per non-background segment.
+
+    At most 2*workers chunks are in flight, so memory does not grow with the
+    number of input files.
+    """
+    chunks = ((species, records, background)
+              for species, records in chunked_records(filenames, chunksize))
+    with (instrument.stage('scan_proteomes', files=len(filenames), workers=workers) as stage,
+          ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(modelfile,)) as pool,
+          open(outfilename, 'w') as outfile):
+        outfile.write('species\tprotein\tlength\tstate\tstart\tend\tmean_posterior\tloglik\n')
+        pending = deque()
+        for chunk in chunks:
+            stage.records += len(chunk[1])
+            pending.append(pool.submit(_scan_chunk, chunk))
+            if len(pending) >= 2*workers:
+                outfile.writelines(pending.popleft().result())
+        while pending:
+            outfile.writelines(pending.popleft().result())
+        # Sequences are read here but decoded in the workers
+        stage.bytes_read = sum(os.path.getsize(filename) for filename in filenames)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Scan ZNF proteomes for HMM segments.')
+    parser.add_argument('model', help='.npz file written by HMM.save')
+    parser.add_argument('fasta', nargs='*', help='default: ../../data/seqs/*_znfs.fa')
+    parser.add_argument('-o', '--out', default='../../data/krab_segments.tsv')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--chunksize', type=int, default=500)
+    parser.add_argument('--background-state', type=int, default=0)
+    args = parser.parse_args()
+    filenames = args.fasta or sorted(glob.glob('../../data/seqs/*_znfs.fa'))
+    if not filenames:
+        sys.exit('No FASTA files to scan')
+    scan(filenames, args.model, args.out, args.workers, args.chunksize, args.background_state)
+
+
+if __name__ == '__main__':
+    main()
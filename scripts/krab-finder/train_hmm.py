@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import argparse
+import numpy as np
+from hmm2 import HMM, attribute_lookup
+from scan_proteomes import read_fasta
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import instrument
+
+
+def random_hmm(nstates, nsymbols, seed=0):
+    """Returns an HMM with Dirichlet-sampled parameters and sticky transitions."""
+    rng = np.random.default_rng(seed)
+    transition = rng.dirichlet(np.ones(nstates), nstates) + 10*np.eye(nstates)
+    transition /= transition.sum(axis=1, keepdims=True)
+    return HMM(nstates, rng.dirichlet(np.ones(nstates)), transition,
+               rng.dirichlet(np.ones(nsymbols), nstates))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Train an HMM on unlabelled sequences with Baum-Welch.')
+    parser.add_argument('fasta', help='e.g. ../../data/seqs/unknown_nterm.fa')
+    parser.add_argument('-o', '--out', default='../../data/krab_hmm.npz')
+    parser.add_argument('--states', type=int, default=2)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--max-iter', type=int, default=100)
+    parser.add_argument('--tol', type=float, default=1e-4)
+    parser.add_argument('--checkpoint', default=None,
+                        help='save parameters here every iteration and resume from it')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    lookup, labels = attribute_lookup()
+    sequences = [lookup[np.frombuffer(seq, dtype=np.uint8)]
+                 for _, seq in read_fasta(args.fasta) if seq]
+    model = random_hmm(args.states, len(labels), args.seed)
+    with instrument.stage('baum_welch', states=args.states, workers=args.workers) as stage:
+        model.fit(sequences, args.max_iter, args.tol, args.workers, checkpoint=args.checkpoint)
+        stage.records = len(sequences)
+    model.save(args.out)
+
+
+if __name__ == '__main__':
+    main()
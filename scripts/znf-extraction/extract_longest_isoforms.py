@@ -1,42 +1,111 @@
 #!/usr/bin/env python3
 
+import io
+import os
 import sys
-import re
+import gzip
+import zipfile
+from array import array
+from contextlib import contextmanager
 from collections import defaultdict
 from Bio import SeqIO
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import instrument
+
+@contextmanager
+def open_input(filename, member=None):
+    """Opens a plain or .gz file, or a member of a zip archive, for binary streaming."""
+    if member is not None:
+        with zipfile.ZipFile(filename) as archive, archive.open(member) as infile:
+            yield infile
+    elif filename.endswith('.gz'):
+        with gzip.open(filename, 'rb') as infile:
+            yield infile
+    else:
+        with open(filename, 'rb') as infile:
+            yield infile
+
+def is_compressed(filename, member=None):
+    return member is not None or filename.endswith('.gz')
+
+def _attribute_id(attribute, line):
+    """Returns the part of an ID=/Parent= value after its prefix, e.g. cds-XP_1.1 -> XP_1.1."""
+    prefix, _, value = attribute.partition('-')
+    if not value or '=' not in prefix:
+        raise ValueError(line)
+    return value
+
+def get_protein_to_gene_index(filename, indexfile=None, member=None):
+    """Returns (protein -> row, gene number per row, gene list) from the mRNA and CDS rows of a GFF.
+
+    Rows number proteins in order of their first CDS row, and each CDS is
+    resolved to its gene as it is read, so apart from the mRNA -> gene map
+    of the pass itself only one dict and an integer array are kept. Only
+    column 3 is checked on most lines, so the GFF is scanned with one tab
+    split per line. If indexfile is given, the index is read from it when
+    it is newer than the GFF and written to it otherwise. The GFF may be
+    gzipped or a member of a zip archive.
+    """
+    if indexfile and os.path.exists(indexfile) and \
+            os.path.getmtime(indexfile) >= os.path.getmtime(filename):
+        return read_protein_to_gene_index(indexfile)
 
-def get_gene_to_protein_dict(filename):
-    """Uses GFF file to assign protein isoforms to their gene of origin."""
     rna_to_gene = {}
-    protein_to_rna = {}
-    with open(filename) as gff:
-        for line in gff:
-            if re.match(r'#', line):
+    proteins = {}
+    gene_of = array('i')
+    gene_numbers = {}
+    pending = {}  # Rows whose CDS came before its mRNA, resolved at the end
+    with open_input(filename, member) as infile:
+        for line in io.TextIOWrapper(infile):
+            if line.startswith('#'):
                 continue
-            
-            feature_type = re.search(r'\t(mRNA|CDS)\t', line)
-            if feature_type:
-                feature_type = feature_type.group(1)
-            else:
+            fields = line.split('\t', 8)
+            if len(fields) < 9 or fields[2] not in ('mRNA', 'CDS'):
                 continue
-            
-            parent_data = re.search(r'\tID=.+?-(.+?);Parent=.+?-(.+?);', line)
-            if parent_data:
-                parent_data = parent_data.groups()
-            else:
+            attributes = fields[8].split(';', 2)
+            if len(attributes) < 3 or not attributes[0].startswith('ID=') \
+                    or not attributes[1].startswith('Parent='):
                 raise ValueError(line)
-            
-            match feature_type:
-                case "CDS":
-                    protein_to_rna[parent_data[0]] = parent_data[1]
-                case "mRNA":
-                    rna_to_gene[parent_data[0]] = parent_data[1]
+            feature_id = _attribute_id(attributes[0], line)
+            parent_id = _attribute_id(attributes[1], line)
+            if fields[2] == 'mRNA':
+                rna_to_gene[feature_id] = parent_id
+            elif feature_id not in proteins:
+                proteins[feature_id] = len(gene_of)
+                if parent_id in rna_to_gene:
+                    gene_of.append(gene_numbers.setdefault(rna_to_gene[parent_id],
+                                                           len(gene_numbers)))
+                else:
+                    pending[len(gene_of)] = parent_id
+                    gene_of.append(-1)
+    for row, rna in pending.items():
+        gene_of[row] = gene_numbers.setdefault(rna_to_gene.get(rna), len(gene_numbers))
+    genes = list(gene_numbers)
+
+    if indexfile:
+        with open(indexfile, 'w') as outfile:
+            for protein, row in proteins.items():
+                outfile.write(f'{protein}\t{genes[gene_of[row]]}\n')
+    return proteins, gene_of, genes
 
+def read_protein_to_gene_index(indexfile):
+    gene_numbers = {}
+    proteins = {}
+    gene_of = array('i')
+    with open(indexfile) as infile:
+        for line in infile:
+            protein, gene = line.rstrip('\n').split('\t')
+            gene = None if gene == 'None' else gene
+            proteins[protein] = len(gene_of)
+            gene_of.append(gene_numbers.setdefault(gene, len(gene_numbers)))
+    return proteins, gene_of, list(gene_numbers)
+
+def get_gene_to_protein_dict(filename):
+    """Uses GFF file to assign protein isoforms to their gene of origin."""
+    proteins, gene_of, genes = get_protein_to_gene_index(filename)
     gene_to_proteins = defaultdict(list)
-    for protein, rna in protein_to_rna.items():
-        gene = rna_to_gene.get(rna, None)
-        gene_to_proteins[gene].append(protein)
-    
+    for protein, row in proteins.items():
+        gene_to_proteins[genes[gene_of[row]]].append(protein)
     return gene_to_proteins
 
 def get_protein_lengths(filename):
@@ -48,24 +117,93 @@ def get_protein_lengths(filename):
         records[record.name] = record
     return prot_lengths, records
 
-def extract_longest_isoform(seqfile, gfffile, outfile):
-    """Extracts single longest isoform for set of protein isoforms associated with a gene"""
-    prot_lengths, records = get_protein_lengths(seqfile)
-    gene_to_proteins = get_gene_to_protein_dict(gfffile)
-    
-    longest_isoforms = [sorted(proteins, key=lambda x: prot_lengths.get(x, 0))[-1] for proteins in
-                        gene_to_proteins.values()]  # Sorted by increasing length
-    
-    longest_isoform_records = [records[prot] for prot in longest_isoforms if records.get(prot, None)]
-
-    SeqIO.write(longest_isoform_records, outfile, 'fasta')
-
-def main(datadir, species):
-    """Run if called by search_proteomes.sh script"""
-    seqfile = f'{datadir}/seqs/{species}.aa.fa'
-    gfffile = f'{datadir}/gffs/{species}.gff'
+def fasta_extents(infile):
+    """Yields (name, sequence length, start offset, end offset) for each record of a binary FASTA stream."""
+    name, length, start, offset = None, 0, 0, 0
+    for line in infile:
+        if line.startswith(b'>'):
+            if name is not None:
+                yield name, length, start, offset
+            name, length, start = line[1:].split(maxsplit=1)[0].decode(), 0, offset
+        else:
+            length += len(line.strip())
+        offset += len(line)
+    if name is not None:
+        yield name, length, start, offset
+
+def find_longest_isoforms(seqfile, proteins, gene_of, member=None):
+    """Streams the FASTA keeping only the longest record per gene.
+
+    Returns {gene number: (protein, length, start offset, end offset)}.
+    Equal-length isoforms are resolved as before: the one listed last in the
+    GFF (the higher row) wins, whatever the FASTA order.
+    """
+    longest = {}
+    best = {}
+    with open_input(seqfile, member) as infile:
+        for name, length, start, end in fasta_extents(infile):
+            row = proteins.get(name)
+            if row is None:
+                continue
+            gene = gene_of[row]
+            if gene not in best or (length, row) > best[gene]:
+                best[gene] = (length, row)
+                longest[gene] = (name, length, start, end)
+    return longest
+
+def write_longest_isoforms(seqfile, longest, outfile, restream=False, member=None):
+    """Copies the winning records from seqfile, unchanged, to outfile.
+
+    Records are read back by seeking to their offsets, or by streaming
+    seqfile again if restream is set or the input is compressed.
+    """
+    extents = sorted((start, end) for _, _, start, end in longest.values())
+    with open_input(seqfile, member) as infile, open(outfile, 'wb') as out:
+        if restream or is_compressed(seqfile, member):
+            starts = set(start for start, _ in extents)
+            offset = 0
+            keep = False
+            for line in infile:
+                if line.startswith(b'>'):
+                    keep = offset in starts
+                if keep:
+                    out.write(line)
+                offset += len(line)
+        else:
+            for start, end in extents:
+                infile.seek(start)
+                out.write(infile.read(end - start))
+
+def extract_longest_isoform(seqfile, gfffile, outfile, indexfile=None,
+                            seqmember=None, gffmember=None):
+    """Extracts single longest isoform for set of protein isoforms associated with a gene.
+
+    Memory holds the protein->gene index and one record extent per gene;
+    sequences are never loaded. seqfile and gfffile may be gzipped, or zip
+    archives (e.g. an NCBI dataset package) read at seqmember/gffmember
+    without unpacking.
+    """
+    proteins, gene_of, _ = get_protein_to_gene_index(gfffile, indexfile, gffmember)
+    longest = find_longest_isoforms(seqfile, proteins, gene_of, seqmember)
+    write_longest_isoforms(seqfile, longest, outfile, member=seqmember)
+    return len(longest)
+
+def main(datadir, species, archive=None, accession=None):
+    """Run if called by search_proteomes.sh script
+
+    With an NCBI dataset archive and its accession, protein.faa and
+    genomic.gff are read from the zip; otherwise from datadir.
+    """
     outfile = f'{datadir}/seqs/{species}.longest_isoform.fa'
-    extract_longest_isoform(seqfile, gfffile, outfile)
+    with instrument.stage('extract_longest_isoform', species=species) as stage:
+        if archive:
+            stage.records = extract_longest_isoform(
+                archive, archive, outfile,
+                seqmember=f'ncbi_dataset/data/{accession}/protein.faa',
+                gffmember=f'ncbi_dataset/data/{accession}/genomic.gff')
+        else:
+            stage.records = extract_longest_isoform(f'{datadir}/seqs/{species}.aa.fa',
+                                                    f'{datadir}/gffs/{species}.gff', outfile)
 
 if __name__ == '__main__':
-    main(sys.argv[1], sys.argv[2])
+    main(*sys.argv[1:5])
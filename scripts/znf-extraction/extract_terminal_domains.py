@@ -1,53 +1,43 @@
 #!/usr/bin/env python3
 
-from Bio import SeqIO
-from Bio import Seq
-from Bio.SeqRecord import SeqRecord
-import re
-from collections import defaultdict
+import os
+import sys
+import numpy as np
+from hmmer_io import read_table
+from fasta_index import FastaIndex, write_fasta
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import instrument
 
 
-def load_znf_doms(species):
+def load_znf_doms(species, datadir='../../data', cache=False):
     """Takes domtblout file and extracts start and end coordinates of first and last znf domains."""
-    hmmfile = f'../../data/hmmer-out/{species}_znf_domains.out'
-    znfdict = defaultdict(list)
-    
-    with open(hmmfile) as infile:
-        for line in infile:
-            if re.match('#', line):
-                continue
-            line = re.findall(r'(.+?)\s+', line)
-            target = line[0]
-            start, end = int(line[19]), int(line[20])
-            znfdict[target].append(start)
-            znfdict[target].append(end)
-    
-    for key, val in znfdict.items():
-        sval = sorted(val)
-        znfdict[key] = [sval[0], sval[-1]]
-    
-    return znfdict
+    hmmfile = f'{datadir}/hmmer-out/{species}_znf_domains.out'
+    table = read_table(hmmfile, ['target_name', 'env_from', 'env_to'], 'domtblout', cache)
+    targets, inverse = np.unique(table['target_name'], return_inverse=True)
+    inverse = inverse.ravel()
+    starts = np.full(len(targets), np.iinfo(np.int64).max)
+    ends = np.full(len(targets), np.iinfo(np.int64).min)
+    np.minimum.at(starts, inverse, np.minimum(table['env_from'], table['env_to']))
+    np.maximum.at(ends, inverse, np.maximum(table['env_from'], table['env_to']))
+    return {target: [start, end] for target, start, end in
+            zip(targets.tolist(), starts.tolist(), ends.tolist())}
 
-def extract_terminal_sequence(species, znf_doms):
-    seqfile = f'../../data/seqs/{species}_znfs.fa'
-    nterm_records, cterm_records = [], []
-    for record in SeqIO.parse(seqfile, 'fasta'):
-        coords = znf_doms.get(record.name, None)
-        if coords == None:
-            continue
-        
-        nterm_id = record.name + '_nterm'
-        nterm_seq = record.seq[:coords[0]]
-        nterm_records.append(SeqRecord(id=nterm_id, seq=nterm_seq, description=record.description))
+def extract_terminal_sequence(species, znf_doms, datadir='../../data'):
+    """Writes the sequence before the first and after the last znf domain of each protein.
 
-        cterm_id = record.name + '_cterm'
-        cterm_seq = record.seq[coords[1]+1:]
-        cterm_records.append(SeqRecord(id=cterm_id, seq=cterm_seq, description=record.description))
-    
-    with (open(f'../../data/seqs/{species}_znfs_nterm.fa', 'w') as nfile,
-          open(f'../../data/seqs/{species}_znfs_cterm.fa', 'w') as cfile):
-        SeqIO.write(nterm_records, nfile, 'fasta')
-        SeqIO.write(cterm_records, cfile, 'fasta')
+    Only the needed byte ranges are read from the indexed FASTA and records
+    are written as they are sliced.
+    """
+    index = FastaIndex(f'{datadir}/seqs/{species}_znfs.fa')
+    with (open(f'{datadir}/seqs/{species}_znfs_nterm.fa', 'wb') as nfile,
+          open(f'{datadir}/seqs/{species}_znfs_cterm.fa', 'wb') as cfile):
+        for name in index.names:
+            coords = znf_doms.get(name, None)
+            if coords == None:
+                continue
+            description = index.header(name)
+            write_fasta(nfile, f'{name}_nterm {description}', index.fetch(name, 0, coords[0]))
+            write_fasta(cfile, f'{name}_cterm {description}', index.fetch(name, coords[1]+1))
 
 def main():
     with open('../../data/refseq_metazoans.tsv') as infile:
@@ -55,10 +45,15 @@ def main():
             line = line.split('\t')
             species = line[2].replace(' ', '_')
             try:
-                znf_doms = load_znf_doms(species)
-                extract_terminal_sequence(species, znf_doms)
+                with instrument.stage('load_znf_doms', species=species) as stage:
+                    znf_doms = load_znf_doms(species, cache=True)
+                    stage.records = len(znf_doms)
+                with instrument.stage('extract_terminal_sequence', species=species) as stage:
+                    extract_terminal_sequence(species, znf_doms)
+                    stage.records = len(znf_doms)
             except:
                 print(f'No data for {species}')
+                instrument.emit('skipped', species=species, reason='no data')
 
 if __name__ == "__main__":
    main() 
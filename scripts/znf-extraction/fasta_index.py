@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+import os
+import mmap
+
+
+def build_fai(filename, indexfile):
+    """Writes a samtools-compatible .fai (name, length, offset, linebases, linewidth)."""
+    entries = []
+    name = None
+    offset = 0
+    with open(filename, 'rb') as infile:
+        for line in infile:
+            if line.startswith(b'>'):
+                if name is not None:
+                    entries.append((name, length, seqoffset, linebases, linewidth))
+                name = line[1:].split(maxsplit=1)[0].decode()
+                length, seqoffset, linebases, linewidth = 0, offset + len(line), 0, 0
+                short_line_seen = False
+            elif name is not None:
+                bases = len(line.rstrip(b'\r\n'))
+                if linebases == 0:
+                    linebases, linewidth = bases, len(line)
+                elif short_line_seen or bases > linebases:
+                    raise ValueError(f'{filename}: record {name} has uneven line lengths')
+                short_line_seen = short_line_seen or bases < linebases
+                length += bases
+            offset += len(line)
+    if name is not None:
+        entries.append((name, length, seqoffset, linebases, linewidth))
+    with open(indexfile, 'w') as outfile:
+        for entry in entries:
+            outfile.write('\t'.join(str(field) for field in entry) + '\n')
+
+
+class FastaIndex(object):
+    """Random access to a FASTA file through a .fai index and a memory map.
+
+    The index is stored next to the FASTA as <filename>.fai and rebuilt when
+    the FASTA is newer. Sequences are sliced straight out of the mapped file
+    without parsing the records around them.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        indexfile = filename + '.fai'
+        if not os.path.exists(indexfile) or \
+                os.path.getmtime(indexfile) < os.path.getmtime(filename):
+            build_fai(filename, indexfile)
+        self.names = []
+        self.entries = {}
+        with open(indexfile) as infile:
+            for line in infile:
+                name, *fields = line.split('\t')
+                self.names.append(name)
+                self.entries[name] = tuple(int(field) for field in fields[:4])
+        with open(filename, 'rb') as infile:
+            self._map = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) \
+                if os.path.getsize(filename) else b''
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def __len__(self):
+        return len(self.names)
+
+    def length(self, name):
+        return self.entries[name][0]
+
+    def _position(self, name, i):
+        _, offset, linebases, linewidth = self.entries[name]
+        if linebases == 0:
+            return offset
+        return offset + (i//linebases)*linewidth + i % linebases
+
+    def fetch(self, name, start=0, end=None):
+        """Returns sequence bytes [start, end) of a record, clamped like a slice."""
+        length = self.entries[name][0]
+        start, end, _ = slice(start, end).indices(length)
+        if start >= end:
+            return b''
+        raw = self._map[self._position(name, start):self._position(name, end - 1) + 1]
+        return raw.replace(b'\n', b'').replace(b'\r', b'')
+
+    def _header_start(self, name):
+        # Search for '\n>' as descriptions may contain '>'
+        return self._map.rfind(b'\n>', 0, self.entries[name][1]) + 1
+
+    def header(self, name):
+        """Returns the full header line of a record without '>'."""
+        start = self._header_start(name)
+        return self._map[start + 1:self.entries[name][1]].rstrip().decode()
+
+    def raw_record(self, name):
+        """Returns the record's bytes exactly as stored, header included."""
+        end = self._map.find(b'\n>', self.entries[name][1] - 1)
+        return self._map[self._header_start(name):end + 1 if end != -1 else len(self._map)]
+
+
+def write_fasta(outfile, title, seq, width=60):
+    """Writes one record to a binary handle with Biopython's default wrapping."""
+    outfile.write(b'>' + title.encode() + b'\n')
+    for i in range(0, len(seq), width):
+        outfile.write(seq[i:i+width])  # seq may be a memoryview, so no concatenation
+        outfile.write(b'\n')
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+import os
+import numpy as np
+
+# Column names and types of HMMER3 --tblout and --domtblout tables
+TBLOUT_COLUMNS = (
+    ('target_name', str), ('target_accession', str), ('query_name', str),
+    ('query_accession', str), ('full_evalue', float), ('full_score', float),
+    ('full_bias', float), ('best_evalue', float), ('best_score', float),
+    ('best_bias', float), ('dom_exp', float), ('dom_reg', int), ('dom_clu', int),
+    ('dom_ov', int), ('dom_env', int), ('dom_dom', int), ('dom_rep', int),
+    ('dom_inc', int), ('description', str),
+)
+DOMTBLOUT_COLUMNS = (
+    ('target_name', str), ('target_accession', str), ('tlen', int), ('query_name', str),
+    ('query_accession', str), ('qlen', int), ('full_evalue', float), ('full_score', float),
+    ('full_bias', float), ('dom_number', int), ('dom_total', int), ('c_evalue', float),
+    ('i_evalue', float), ('dom_score', float), ('dom_bias', float), ('hmm_from', int),
+    ('hmm_to', int), ('ali_from', int), ('ali_to', int), ('env_from', int), ('env_to', int),
+    ('acc', float), ('description', str),
+)
+FORMATS = {'tblout': TBLOUT_COLUMNS, 'domtblout': DOMTBLOUT_COLUMNS}
+CACHE_VERSION = 2  # Caches of older versions are reparsed
+
+
+def parse_table(filename, fields, fmt='tblout'):
+    """Parses only the requested columns of a HMMER table into NumPy arrays.
+
+    Each line is split once, no further than the last requested column; the
+    free-text description is only kept when asked for, and then kept whole.
+    """
+    columns = FORMATS[fmt]
+    names = [name for name, _ in columns]
+    indices = [names.index(field) for field in fields]
+    maxsplit = min(max(indices) + 1, len(columns) - 1) if indices else 0
+    values = [[] for _ in fields]
+    with open(filename) as infile:
+        for line in infile:
+            if line.startswith('#'):
+                continue
+            line = line.rstrip('\n').split(maxsplit=maxsplit)
+            for column, i in zip(values, indices):
+                column.append(line[i] if i < len(line) else '')
+    return {field: np.array(column, dtype=columns[i][1])
+            for field, i, column in zip(fields, indices, values)}
+
+
+def read_table(filename, fields, fmt='tblout', cache=False):
+    """Returns {field: array} for a HMMER table, optionally via a .npz cache.
+
+    The cache sits next to the table as <filename>.npz and is only used
+    while the table's size and mtime are unchanged. Fields missing from a
+    valid cache are parsed and added to it.
+    """
+    fields = list(fields)
+    if not cache:
+        return parse_table(filename, fields, fmt)
+
+    cachefile = filename + '.npz'
+    stat = os.stat(filename)
+    cached = {}
+    if os.path.exists(cachefile):
+        with np.load(cachefile) as npz:
+            if ('_version' in npz.files and npz['_version'] == CACHE_VERSION and
+                    npz['_mtime'] == stat.st_mtime_ns and npz['_size'] == stat.st_size):
+                cached = {key: npz[key] for key in npz.files if not key.startswith('_')}
+    missing = [field for field in fields if field not in cached]
+    if missing:
+        cached.update(parse_table(filename, missing, fmt))
+        with open(cachefile + '.tmp', 'wb') as outfile:
+            np.savez(outfile, _version=CACHE_VERSION, _mtime=stat.st_mtime_ns, _size=stat.st_size, **cached)
+        os.replace(cachefile + '.tmp', cachefile)
+    return {field: cached[field] for field in fields}
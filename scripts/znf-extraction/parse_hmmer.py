@@ -1,36 +1,36 @@
 #!/usr/bin/env python3
 
-import re
+import os
 import sys
-from Bio import SeqIO
+from hmmer_io import read_table
+from fasta_index import FastaIndex
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import instrument
 
-def filter_znfs(filename, min_znf_domains=5, max_znf_domains=40):
+def filter_znfs(filename, min_znf_domains=5, max_znf_domains=40, cache=False):
     """Return list of ZNF proteins with between min and and max domain copies."""
-    filtered_znf_accessions = []
-    with open(filename) as infile:
-        for line in infile:
-            if re.match('#', line):
-                continue
-            line = re.findall(r'(.+?)\s+', line)
-            line = line[:4] + \
-                   [float(x) for x in line[4:11]] + \
-                   [int(x) for x in line[11:18]] + \
-                   [' '.join(line[18:])]
-            if line[16] >= min_znf_domains and line[16] <= max_znf_domains:
-                filtered_znf_accessions.append(line[0])
-    return set(filtered_znf_accessions)
+    table = read_table(filename, ['target_name', 'dom_rep'], 'tblout', cache)
+    keep = (table['dom_rep'] >= min_znf_domains) & (table['dom_rep'] <= max_znf_domains)
+    return set(table['target_name'][keep].tolist())
+
+def write_znfs(hmmfile, seqfile, outfile, cache=True):
+    """Copies records of seqfile that pass filter_znfs to outfile; returns how many."""
+    znf_accessions = filter_znfs(hmmfile, cache=cache)
+    index = FastaIndex(seqfile)
+    written = 0
+    with open(outfile, 'wb') as out:
+        for name in index.names:
+            if name in znf_accessions:
+                out.write(index.raw_record(name))
+                written += 1
+    return written
 
 def main(datadir, species):
     hmmfile = f'{datadir}/hmmer-out/{species}_znf.out'
     seqfile = f'{datadir}/seqs/{species}.longest_isoform.fa'
     outfile = f'{datadir}/seqs/{species}_znfs.fa'
-    
-    znf_accessions = filter_znfs(hmmfile)
-    filtered_records = []
-    for record in SeqIO.parse(seqfile, 'fasta'):
-        if record.name in znf_accessions:
-            filtered_records.append(record)
-    SeqIO.write(filtered_records, outfile, 'fasta')
+    with instrument.stage('write_znfs', species=species) as stage:
+        stage.records = write_znfs(hmmfile, seqfile, outfile)
 
 if __name__ == '__main__':
     main(sys.argv[1], sys.argv[2])
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import shutil
+import zipfile
+import argparse
+import tempfile
+import threading
+import subprocess
+from queue import Queue
+from concurrent.futures import ThreadPoolExecutor
+from extract_longest_isoforms import extract_longest_isoform
+from parse_hmmer import write_znfs
+from species_table import read_species
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import instrument
+
+DONE = None
+_print_lock = threading.Lock()
+
+
+def log(species, message):
+    with _print_lock:
+        print(f'[{species}] {message}', flush=True)
+
+
+def fetch(accession, species, scratch, args):
+    """Downloads (or finds) the genome package.
+
+    Returns the archive path, or None if there is no data for the species.
+    """
+    archive = os.path.join(args.zip_dir, f'{accession}.zip') if args.zip_dir else None
+    if not archive or not os.path.exists(archive):
+        if args.offline:
+            log(species, 'no local genome package')
+            instrument.emit('skipped', species=species, reason='no local genome package')
+            return None
+        log(species, 'downloading')
+        archive = os.path.join(scratch, f'{accession}.zip')
+        with instrument.stage('download', species=species) as stage:
+            subprocess.run(['datasets', 'download', 'genome', 'accession', accession,
+                            '--include', 'protein,gff3', '--no-progressbar', '--filename', archive],
+                           stdout=subprocess.DEVNULL, check=False)
+            stage.bytes_written = os.path.getsize(archive) if os.path.exists(archive) else 0
+    if not os.path.exists(archive) or not os.path.getsize(archive):
+        log(species, 'genome not downloaded')
+        instrument.emit('skipped', species=species, reason='genome not downloaded')
+        return None
+    return archive
+
+
+def search(accession, species, archive, scratch, args, cpus):
+    """Runs longest-isoform extraction, hmmsearch and ZNF filtering in scratch.
+
+    protein.faa and genomic.gff are streamed out of the archive; only the
+    GFF is written back out, once, to datadir/gffs.
+    """
+    log(species, 'extracting longest isoforms')
+    longest = os.path.join(scratch, 'longest_isoform.fa')
+    members = f'ncbi_dataset/data/{accession}'
+    with instrument.stage('extract_longest_isoform', species=species) as stage:
+        stage.records = extract_longest_isoform(archive, archive, longest,
+                                                seqmember=f'{members}/protein.faa',
+                                                gffmember=f'{members}/genomic.gff')
+        with (zipfile.ZipFile(archive) as package,
+              package.open(f'{members}/genomic.gff') as src,
+              open(f'{args.datadir}/gffs/{species}.gff', 'wb') as dst):
+            shutil.copyfileobj(src, dst, 1 << 20)
+
+    log(species, f'searching for ZNF sequences ({cpus} cpus)')
+    tblout = f'{args.datadir}/hmmer-out/{species}_znf.out'
+    with instrument.stage('hmmsearch', species=species, cpus=cpus) as stage:
+        subprocess.run(['hmmsearch', '-o', os.path.join(scratch, 'hmmsearch.out'),
+                        '--tblout', tblout, '--noali',
+                        '-E', '0.01', '--domE', '0.01', '--incE', '0.01', '--incdomE', '0.01',
+                        '--cpu', str(cpus), f'{args.datadir}/phmms/{args.hmm}', longest],
+                       check=True)
+        # hmmsearch runs in a child process, so its I/O is not in /proc/self/io
+        stage.bytes_read = os.path.getsize(longest)
+        stage.bytes_written = os.path.getsize(tblout)
+
+    log(species, 'extracting ZNFs from HMMER output')
+    with instrument.stage('write_znfs', species=species) as stage:
+        stage.records = write_znfs(tblout, longest, f'{args.datadir}/seqs/{species}_znfs.fa')
+
+
+def search_worker(queue, args, cpus):
+    while True:
+        item = queue.get()
+        if item is DONE:
+            return
+        accession, species, archive, scratch = item
+        try:
+            search(accession, species, archive, scratch, args, cpus)
+        except Exception as error:
+            log(species, f'failed: {error}')
+            instrument.emit('failed', species=species, error=repr(error))
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+
+def fetch_worker(queue, accession, species, args):
+    scratch = tempfile.mkdtemp(prefix=f'{species}.', dir=args.scratch)
+    try:
+        archive = fetch(accession, species, scratch, args)
+    except Exception as error:
+        log(species, f'failed: {error}')
+        instrument.emit('failed', species=species, error=repr(error))
+        archive = None
+    if archive:
+        queue.put((accession, species, archive, scratch))  # Blocks while searches are behind
+    else:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def run(args):
+    """Overlaps downloads with hmmsearch jobs that share the core budget.
+
+    At most args.jobs downloaded genomes wait for a search slot, which bounds
+    scratch space.
+    """
+    os.makedirs(args.scratch, exist_ok=True)
+    cpus = max(1, args.cpus//args.jobs)
+    queue = Queue(maxsize=args.jobs)
+    searchers = [threading.Thread(target=search_worker, args=(queue, args, cpus))
+                 for _ in range(args.jobs)]
+    for thread in searchers:
+        thread.start()
+    with ThreadPoolExecutor(args.downloads) as fetchers:
+        for accession, species in read_species(f'{args.datadir}/refseq_metazoans.tsv'):
+            if os.path.exists(f'{args.datadir}/seqs/{species}_znfs.fa') and \
+                    os.path.getsize(f'{args.datadir}/seqs/{species}_znfs.fa'):
+                log(species, 'data already exists')
+                continue
+            fetchers.submit(fetch_worker, queue, accession, species, args)
+    for _ in searchers:
+        queue.put(DONE)
+    for thread in searchers:
+        thread.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Concurrent replacement for search_proteomes.sh.')
+    parser.add_argument('--datadir', default='../../data')
+    parser.add_argument('--hmm', default='PF00096.hmm')
+    parser.add_argument('--scratch', default='./scratch',
+                        help='parent of the per-species scratch directories')
+    parser.add_argument('--zip-dir', default=None,
+                        help='directory of pre-downloaded <accession>.zip genome packages')
+    parser.add_argument('--offline', action='store_true',
+                        help='never call datasets; skip species without a local package')
+    parser.add_argument('--cpus', type=int, default=os.cpu_count(),
+                        help='cores shared by concurrent hmmsearch jobs')
+    parser.add_argument('--jobs', type=int, default=2, help='concurrent hmmsearch jobs')
+    parser.add_argument('--downloads', type=int, default=2, help='concurrent downloads')
+    run(parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
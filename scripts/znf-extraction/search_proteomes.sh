@@ -33,14 +33,10 @@ while read -r line; do
         continue
     fi
 
-    echo "Unzipping genome..."
-    unzip -qq "${accession}.zip"
-    mv "./ncbi_dataset/data/${accession}/protein.faa" "${DATADIR}/seqs/${species}.aa.fa" 
-    mv "./ncbi_dataset/data/${accession}/genomic.gff" "${DATADIR}/gffs/${species}.gff"
-    
     echo "Extracting longest isoforms..."
-    ./extract_longest_isoforms.py $DATADIR $species
-    rm "${DATADIR}/seqs/${species}.aa.fa"  # Redundant fasta containing irrelevant isoforms 
+    # protein.faa and genomic.gff are streamed from the zip, not unpacked
+    ./extract_longest_isoforms.py $DATADIR $species "${accession}.zip" $accession
+    unzip -p "${accession}.zip" "ncbi_dataset/data/${accession}/genomic.gff" > "${DATADIR}/gffs/${species}.gff"
 
     echo "Searching for ZNF sequences..."
     hmmsearch \
@@ -59,7 +55,7 @@ while read -r line; do
     ./parse_hmmer.py $DATADIR $species
 
     echo "Cleaning up..."
-    rm -r ./README.md ./ncbi_dataset "./${accession}.zip"
+    rm "./${accession}.zip"
     rm tmp.out
     rm "${DATADIR}/seqs/${species}.longest_isoform.fa"
     
@@ -0,0 +1,11 @@
+#!/usr/bin/env python3
+
+
+def read_species(filename):
+    """Yields (accession, species) pairs from refseq_metazoans.tsv."""
+    with open(filename) as infile:
+        for line in infile:
+            line = line.rstrip('\n').split('\t')
+            if line[0] == 'Assembly Accession':
+                continue
+            yield line[0], line[2].replace(' ', '_')
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import mmap
+import argparse
+import numpy as np
+from hmmer_io import read_table
+from fasta_index import FastaIndex, write_fasta
+from species_table import read_species
+
+# Per-protein columns of the coordinate table. Coordinates are 1-based and
+# inclusive, as in the domtblout env_from/env_to columns.
+COLUMNS = ('species', 'name', 'description', 'length', 'offset', 'first_start', 'first_end',
+           'last_start', 'last_end', 'ndoms', 'spacing', 'dom_offset')
+REGIONS = ('nterm', 'cterm', 'linkers', 'full')
+
+
+def znf_domains(hmmfile, cache=False):
+    """Returns {protein: (starts, ends)} of the ZNF domains in a domtblout file, sorted by start."""
+    table = read_table(hmmfile, ['target_name', 'env_from', 'env_to'], 'domtblout', cache)
+    starts = np.minimum(table['env_from'], table['env_to'])
+    ends = np.maximum(table['env_from'], table['env_to'])
+    order = np.lexsort((starts, table['target_name']))
+    targets, starts, ends = table['target_name'][order], starts[order], ends[order]
+    bounds = np.flatnonzero(targets[1:] != targets[:-1]) + 1
+    groups = zip(np.concatenate([[0], bounds]), np.concatenate([bounds, [len(targets)]]))
+    return {targets[i]: (starts[i:j], ends[i:j]) for i, j in groups}
+
+
+def build_store(species_list, prefix, datadir='../../data', cache=False):
+    """Writes the coordinate table to {prefix}.npz and the sequences to {prefix}.seq.
+
+    Each species' {species}_znf_domains.out is read once and its
+    {species}_znfs.fa once. Proteins with ZNF hits are appended to a single
+    concatenated sequence file, without headers or newlines, in FASTA order.
+    Species without data are skipped. Returns the number of proteins stored.
+    """
+    columns = {column: [] for column in COLUMNS}
+    dom_starts, dom_ends = [], []
+    offset = dom_offset = 0
+    with open(prefix + '.seq.tmp', 'wb') as seqfile:
+        for species in species_list:
+            hmmfile = f'{datadir}/hmmer-out/{species}_znf_domains.out'
+            fastafile = f'{datadir}/seqs/{species}_znfs.fa'
+            if not os.path.exists(hmmfile) or not os.path.exists(fastafile):
+                print(f'No data for {species}')
+                continue
+            domains = znf_domains(hmmfile, cache)
+            index = FastaIndex(fastafile)
+            for name in index.names:
+                if name not in domains:
+                    continue
+                starts, ends = domains[name]
+                seq = index.fetch(name)
+                seqfile.write(seq)
+                last = np.argmax(ends)
+                gaps = starts[1:] - ends[:-1] - 1
+                for column, value in (
+                        ('species', species), ('name', name),
+                        ('description', index.header(name)), ('length', len(seq)),
+                        ('offset', offset), ('first_start', starts[0]),
+                        ('first_end', ends[0]), ('last_start', starts[last]),
+                        ('last_end', ends[last]), ('ndoms', len(starts)),
+                        ('spacing', np.median(gaps) if len(gaps) else np.nan),
+                        ('dom_offset', dom_offset)):
+                    columns[column].append(value)
+                dom_starts.append(starts)
+                dom_ends.append(ends)
+                offset += len(seq)
+                dom_offset += len(starts)
+    columns['dom_offset'].append(dom_offset)  # CSR-style: one more offset than rows
+    with open(prefix + '.npz.tmp', 'wb') as outfile:
+        np.savez(outfile, **{column: np.array(values) for column, values in columns.items()},
+                 dom_starts=np.concatenate(dom_starts or [[]]).astype(np.int64),
+                 dom_ends=np.concatenate(dom_ends or [[]]).astype(np.int64))
+    os.replace(prefix + '.seq.tmp', prefix + '.seq')
+    os.replace(prefix + '.npz.tmp', prefix + '.npz')
+    return len(columns['name'])
+
+
+class TerminalStore(object):
+    """Coordinate table plus memory-mapped sequences written by build_store.
+
+    Columns are NumPy arrays in self.table, so proteins can be selected with
+    ordinary masks, e.g. store.rows(store.table['ndoms'] >= 10). Regions
+    are returned as memoryviews into the mapped sequence file; nothing is
+    copied until the caller converts them with bytes() or writes them out.
+    N- and C-terminal regions match those of extract_terminal_sequence.
+    """
+
+    def __init__(self, prefix):
+        with np.load(prefix + '.npz') as npz:
+            self.table = {column: npz[column] for column in COLUMNS}
+            self.dom_starts = npz['dom_starts']
+            self.dom_ends = npz['dom_ends']
+        with open(prefix + '.seq', 'rb') as infile:
+            self._map = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) \
+                if os.path.getsize(prefix + '.seq') else b''
+        self._view = memoryview(self._map)
+        self._rows = {(species, name): i for i, (species, name) in
+                      enumerate(zip(self.table['species'].tolist(), self.table['name'].tolist()))}
+
+    def __len__(self):
+        return len(self.table['name'])
+
+    def row(self, species, name):
+        return self._rows[(species, name)]
+
+    def rows(self, mask=None, species=None):
+        """Returns row indices selected by a boolean mask and/or a species list."""
+        selected = np.ones(len(self), dtype=bool) if mask is None else np.asarray(mask)
+        if species is not None:
+            selected = selected & np.isin(self.table['species'], list(species))
+        return np.flatnonzero(selected)
+
+    def region(self, i, start=0, end=None):
+        """Returns residues [start, end) (0-based) of protein i as a memoryview."""
+        length = int(self.table['length'][i])
+        start, end, _ = slice(start, end).indices(length)
+        offset = int(self.table['offset'][i])
+        return self._view[offset + start:offset + max(start, end)]
+
+    def sequence(self, i):
+        return self.region(i)
+
+    def nterm(self, i):
+        return self.region(i, 0, int(self.table['first_start'][i]))
+
+    def cterm(self, i):
+        return self.region(i, int(self.table['last_end'][i]) + 1)
+
+    def domains(self, i):
+        """Returns (starts, ends) of the ZNF domains of protein i, 1-based inclusive."""
+        lo, hi = self.table['dom_offset'][i], self.table['dom_offset'][i + 1]
+        return self.dom_starts[lo:hi], self.dom_ends[lo:hi]
+
+    def linkers(self, i):
+        """Returns the regions between consecutive ZNF domains of protein i."""
+        starts, ends = self.domains(i)
+        return [self.region(i, int(end), int(start) - 1)
+                for end, start in zip(ends[:-1], starts[1:])]
+
+    def regions(self, kind, rows=None):
+        """Yields (row, label, memoryview) for a region kind over the selected rows."""
+        if kind not in REGIONS:
+            raise ValueError(f'region must be one of {REGIONS}')
+        for i in range(len(self)) if rows is None else rows:
+            if kind == 'linkers':
+                for n, linker in enumerate(self.linkers(i)):
+                    yield i, f'linker{n + 1}', linker
+            elif kind == 'full':
+                yield i, kind, self.sequence(i)
+            else:
+                yield i, kind, getattr(self, kind)(i)
+
+    def write_fasta(self, outfile, kind, rows=None):
+        """Writes regions to a binary handle, headed like extract_terminal_sequence's files."""
+        names, descriptions = self.table['name'], self.table['description']
+        for i, label, seq in self.regions(kind, rows):
+            write_fasta(outfile, f'{names[i]}_{label} {descriptions[i]}', seq)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Terminal/linker regions of ZNF proteins '
+                                     'from a coordinate table and sequence store.')
+    parser.add_argument('--prefix', default='../../data/znf_store')
+    commands = parser.add_subparsers(dest='command', required=True)
+    build = commands.add_parser('build', help='build the table and store for all species')
+    build.add_argument('--datadir', default='../../data')
+    extract = commands.add_parser('extract', help='write selected regions as FASTA')
+    extract.add_argument('region', choices=REGIONS)
+    extract.add_argument('-o', '--out', default='-')
+    extract.add_argument('--species', nargs='+', default=None)
+    extract.add_argument('--min-domains', type=int, default=0)
+    extract.add_argument('--min-length', type=int, default=0,
+                         help='minimum length of the whole protein')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        species = [species for _, species in read_species(f'{args.datadir}/refseq_metazoans.tsv')]
+        stored = build_store(species, args.prefix, args.datadir, cache=True)
+        print(f'{stored} proteins stored in {args.prefix}.npz/.seq')
+        return
+
+    store = TerminalStore(args.prefix)
+    rows = store.rows((store.table['ndoms'] >= args.min_domains) &
+                      (store.table['length'] >= args.min_length), args.species)
+    if args.out == '-':
+        store.write_fasta(sys.stdout.buffer, args.region, rows)
+    else:
+        with open(args.out, 'wb') as outfile:
+            store.write_fasta(outfile, args.region, rows)
+
+
+if __name__ == '__main__':
+    main()